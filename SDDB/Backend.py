@@ -0,0 +1,517 @@
+import time
+import asyncio
+import logging
+import weakref
+import aiohttp
+import discord
+from collections import OrderedDict
+from .Instrumentation import current_task
+
+# Storage backends hold the categories (databases), text channels (tables) and messages (rows) SDDB works on.
+# DBMS only talks to its backend, so the same engine runs against a Discord guild or entirely in memory.
+# - Categories and channels are objects with an id and name, channels also have a category (None for categories).
+# - Messages are objects with an id and content, history is returned newest first.
+# - Backends that see their own changes dispatch them to listeners as message events, see DBMS.message_event.
+# - Backends report each Discord API request an operation makes (or stands in for) to monitors, see DBMS.request_event.
+# - Several clients of the same guild can be pooled into one backend, see BackendPool.
+
+HISTORY_PAGE = 100 # messages per history request
+
+# operation -> Discord REST route it is made with
+ROUTES = {
+	"create_category": "POST /guilds/{guild_id}/channels",
+	"create_text_channel": "POST /guilds/{guild_id}/channels",
+	"rename_channel": "PATCH /channels/{channel_id}",
+	"delete_channel": "DELETE /channels/{channel_id}",
+	"history": "GET /channels/{channel_id}/messages",
+	"send": "POST /channels/{channel_id}/messages",
+	"edit_message": "PATCH /channels/{channel_id}/messages/{message_id}",
+	"delete_message": "DELETE /channels/{channel_id}/messages/{message_id}",
+	"fetch_message": "GET /channels/{channel_id}/messages/{message_id}",
+}
+
+# route -> (requests, per seconds) each token may make per major parameter (channel or guild), approximations of
+# Discord's published and observed limits, Discord sends the real ones with every response
+RATE_LIMITS = {
+	ROUTES["history"]: (5, 1.0),
+	ROUTES["fetch_message"]: (5, 1.0),
+	ROUTES["send"]: (5, 5.0),
+	ROUTES["edit_message"]: (5, 5.0),
+	ROUTES["delete_message"]: (5, 1.0),
+	ROUTES["create_text_channel"]: (5, 5.0),
+	ROUTES["rename_channel"]: (2, 600.0),
+	ROUTES["delete_channel"]: (5, 5.0),
+}
+GLOBAL_RATE_LIMIT = (50, 1.0) # requests per second a token may make across all routes
+
+def history_requests(count, limit=1024):
+	"""Requests made by a history call returning count messages, history stops at a short page or the limit"""
+	if count >= limit:
+		return -(-limit // HISTORY_PAGE)
+	return count // HISTORY_PAGE + 1
+
+def history_pages(messages, limit):
+	"""Splits a history result into the pages it was requested in"""
+	return [messages[i * HISTORY_PAGE:(i + 1) * HISTORY_PAGE] for i in range(history_requests(len(messages), limit))]
+
+class Backend:
+	"""Interface for the guild operations SDDB uses"""
+	def __init__(self):
+		self.guild_id = None
+		self.listeners = []
+		self.monitors = []
+
+	def add_listener(self, callback):
+		"""Registers callback(kind, channel, message_id, content, before) for message events"""
+		self.listeners.append(callback)
+
+	def remove_listener(self, callback):
+		self.listeners.remove(callback)
+
+	def dispatch(self, kind, channel, message_id, content=None, before=None):
+		for callback in list(self.listeners):
+			callback(kind, channel, message_id, content, before)
+
+	def add_monitor(self, callback):
+		"""Registers callback(route, size, wait) for every API request"""
+		self.monitors.append(callback)
+
+	def remove_monitor(self, callback):
+		self.monitors.remove(callback)
+
+	def report_request(self, route, size=0, wait=0.0):
+		"""Reports an API request with the bytes of content it carried and the seconds it waited on rate limits"""
+		for callback in list(self.monitors):
+			callback(route, size, wait)
+
+	def close(self):
+		"""Releases what the backend holds, it makes no requests afterwards"""
+		pass
+
+	def administrator(self):
+		"""True if SDDB may create and drop channels"""
+		return True
+
+	def available(self):
+		"""True if the client is connected and can make requests"""
+		return True
+
+	def failed(self, error):
+		"""True if error is the client's fault rather than the request's, like a lost connection, so another client can retry"""
+		return isinstance(error, (ConnectionError, asyncio.TimeoutError))
+
+	def refused(self, error):
+		"""True if the request failed without being carried out, like when rate limited, so even writes can be retried"""
+		return False
+
+	def concurrency(self):
+		"""Requests worth making at once, more than one for backends with several clients"""
+		return 1
+
+	def local(self, obj):
+		"""This client's handle on a category, channel or message another client of the same guild returned"""
+		return obj
+
+	def owns(self, channel):
+		"""True if channel belongs to this backend's guild"""
+		raise NotImplementedError
+
+	def categories(self):
+		raise NotImplementedError
+
+	def channels(self, category):
+		raise NotImplementedError
+
+	def get_channel(self, id):
+		"""Returns the category or channel with id, None if there is none"""
+		raise NotImplementedError
+
+	async def create_category(self, name, reason=None):
+		raise NotImplementedError
+
+	async def create_text_channel(self, name, category, reason=None):
+		raise NotImplementedError
+
+	async def rename_channel(self, channel, name, reason=None):
+		"""Renames a category or channel"""
+		raise NotImplementedError
+
+	async def delete_channel(self, channel, reason=None):
+		"""Deletes a category or channel"""
+		raise NotImplementedError
+
+	async def history(self, channel, limit=1024, before=None, after=None):
+		"""Returns up to limit messages in channel, newest first
+
+		before and after are message ids that bound the messages returned, exclusive.  Like Discord, with after
+		the limit keeps the oldest messages after it, otherwise the newest."""
+		raise NotImplementedError
+
+	async def send(self, channel, content):
+		raise NotImplementedError
+
+	async def edit_message(self, message, content):
+		raise NotImplementedError
+
+	async def delete_message(self, message):
+		raise NotImplementedError
+
+	async def fetch_message(self, channel, id):
+		"""Returns the message with id in channel, None if there is none"""
+		raise NotImplementedError
+
+	def partial_message(self, channel, id):
+		"""A message with id in channel to edit or delete without fetching it"""
+		raise NotImplementedError
+
+class DiscordBackend(Backend):
+	"""A Discord guild through a Rapptz Discord.py client"""
+	def __init__(self, discord_client, database_guild):
+		if not isinstance(discord_client, discord.Client):
+			raise TypeError("discord_client must be a discord.Client")
+		Backend.__init__(self)
+		self.d = discord_client
+		self.db = None
+		if isinstance(database_guild, discord.Guild):
+			self.db = database_guild
+		elif isinstance(database_guild, int):
+			self.db = self.d.get_guild(database_guild)
+			if self.db is None:
+				raise Exception("guild does not exist: " + str(database_guild))
+		else:
+			raise TypeError("database_guild must be an int or guild object")
+		self.guild_id = self.db.id
+		self.rate_limits = RATE_LIMIT_LOG
+		self.rate_limits.attach(self)
+
+	def close(self):
+		self.rate_limits.detach(self)
+
+	def administrator(self):
+		return self.db.me.guild_permissions.administrator
+
+	def available(self):
+		return not self.d.is_closed()
+
+	def failed(self, error):
+		if isinstance(error, discord.HTTPException) and error.status >= 500:
+			return True
+		return Backend.failed(self, error) or isinstance(error, aiohttp.ClientError) or self.refused(error)
+
+	def refused(self, error):
+		if isinstance(error, discord.HTTPException):
+			return error.status == 429 # discord.py gave up retrying
+		return isinstance(error, aiohttp.ClientConnectorError) # never reached Discord
+
+	def local(self, obj):
+		if isinstance(obj, discord.abc.GuildChannel):
+			channel = self.db.get_channel(obj.id)
+			if channel is None:
+				raise NameError("Unknown channel: " + str(obj.id))
+			return channel
+		channel = self.local(obj.channel)
+		if channel is obj.channel:
+			return obj
+		return channel.get_partial_message(obj.id) # discord.py 1.6+
+
+	def owns(self, channel):
+		return getattr(channel, "guild", None) is not None and channel.guild.id == self.db.id
+
+	def categories(self):
+		return self.db.categories
+
+	def channels(self, category):
+		return category.channels
+
+	def get_channel(self, id):
+		return self.db.get_channel(id)
+
+	async def create_category(self, name, reason=None):
+		overwrites = {
+		    self.db.default_role: discord.PermissionOverwrite(read_messages=False),
+		    self.db.me: discord.PermissionOverwrite(read_messages=True)
+		    }
+		self.rate_limits.start(self)
+		category = await self.db.create_category(name, overwrites=overwrites, reason=reason)
+		self.report("create_category", len(name))
+		return category
+
+	async def create_text_channel(self, name, category, reason=None):
+		self.rate_limits.start(self)
+		channel = await self.db.create_text_channel(name, category=category, reason=reason)
+		self.report("create_text_channel", len(name))
+		return channel
+
+	async def rename_channel(self, channel, name, reason=None):
+		self.rate_limits.start(self)
+		await channel.edit(name=name, reason=reason)
+		self.report("rename_channel", len(name))
+
+	async def delete_channel(self, channel, reason=None):
+		self.rate_limits.start(self)
+		await channel.delete(reason=reason)
+		self.report("delete_channel")
+
+	async def history(self, channel, limit=1024, before=None, after=None):
+		if before is not None:
+			before = discord.Object(id=before)
+		if after is not None:
+			after = discord.Object(id=after)
+		self.rate_limits.start(self)
+		messages = await channel.history(limit=limit, before=before, after=after).flatten()
+		if after is not None: # paged oldest first from after
+			messages.reverse()
+		for page in history_pages(messages, limit):
+			self.report("history", sum(len(m.content) for m in page))
+		return messages
+
+	async def send(self, channel, content):
+		self.rate_limits.start(self)
+		message = await channel.send(content)
+		self.report("send", len(content))
+		return message
+
+	async def edit_message(self, message, content):
+		self.rate_limits.start(self)
+		await message.edit(content=content)
+		self.report("edit_message", len(content))
+		return message
+
+	async def delete_message(self, message):
+		self.rate_limits.start(self)
+		await message.delete()
+		self.report("delete_message")
+
+	async def fetch_message(self, channel, id):
+		self.rate_limits.start(self)
+		try:
+			message = await channel.fetch_message(id)
+		except discord.NotFound:
+			self.report("fetch_message")
+			return None
+		self.report("fetch_message", len(message.content))
+		return message
+
+	def partial_message(self, channel, id):
+		return channel.get_partial_message(id) # discord.py 1.6+
+
+	def report(self, operation, size=0):
+		self.report_request(ROUTES[operation], size, self.rate_limits.pop(self))
+
+class RateLimitLog(logging.Handler):
+	"""Collects the rate limit retries discord.py logs while a task makes a request through a DiscordBackend
+
+	One log is shared by every DiscordBackend and attached to the discord.http logger while any is open.  discord.py
+	logs the retries of every client there, a retry counts for the backend whose request the logging task is making.
+	Waits for a bucket another request exhausted are not logged per request and only show in statement durations."""
+	def __init__(self):
+		logging.Handler.__init__(self, logging.WARNING)
+		self.backends = weakref.WeakSet() # open DiscordBackends
+		self.requests = weakref.WeakKeyDictionary() # task -> (backend, seconds waited) of the request it is making
+
+	def attach(self, backend):
+		if len(self.backends) == 0:
+			logging.getLogger("discord.http").addHandler(self)
+		self.backends.add(backend)
+
+	def detach(self, backend):
+		self.backends.discard(backend)
+		if len(self.backends) == 0:
+			logging.getLogger("discord.http").removeHandler(self)
+
+	def start(self, backend):
+		"""Counts the retries the current task logs from now on for a request of backend"""
+		task = current_task()
+		if task is not None:
+			self.requests[task] = (backend, 0.0)
+
+	def emit(self, record):
+		if "rate limit" not in str(record.msg) or not record.args or not isinstance(record.args[0], float):
+			return
+		task = current_task()
+		if task is not None and task in self.requests:
+			backend, wait = self.requests[task]
+			self.requests[task] = (backend, wait + record.args[0])
+
+	def pop(self, backend):
+		"""Seconds the current task waited on its request of backend since the last pop"""
+		task = current_task()
+		if task is None or task not in self.requests or self.requests[task][0] is not backend:
+			return 0.0
+		backend, wait = self.requests[task]
+		self.requests[task] = (backend, 0.0) # a history request reports every page it made
+		return wait
+
+RATE_LIMIT_LOG = RateLimitLog()
+
+# MEMORY #
+
+DISCORD_EPOCH = 1420070400000 # first millisecond of 2015, snowflake timestamps count from here
+MAX_MESSAGE_LENGTH = 2000
+
+class MemoryCategory:
+	def __init__(self, id, name):
+		self.id = id
+		self.name = name
+		self.category = None
+		self.channels = []
+
+class MemoryChannel:
+	def __init__(self, id, name, category):
+		self.id = id
+		self.name = name
+		self.category = category
+		self.messages = OrderedDict() # id -> MemoryMessage, oldest first
+
+class MemoryMessage:
+	def __init__(self, id, channel, content):
+		self.id = id
+		self.channel = channel
+		self.content = content
+
+class MemoryBackend(Backend):
+	"""An in memory guild for running SDDB offline
+
+	Simulates categories, text channels with Discord's lowercased names, snowflake ids and the 2000
+	character message limit, and dispatches message events for every change like the gateway would."""
+	last_timestamp = 0 # snowflakes are unique across every MemoryBackend, like across Discord
+	increment = 0
+
+	def __init__(self, guild_id=None, shared=None):
+		Backend.__init__(self)
+		self.connected = True # False simulates a lost connection, requests then raise ConnectionError
+		if shared is not None: # another client of the same guild, like a second bot token
+			self.objects = shared.objects
+			self.category_list = shared.category_list
+			self.guild_id = shared.guild_id
+		else:
+			self.objects = {} # id -> MemoryCategory or MemoryChannel
+			self.category_list = []
+			self.guild_id = guild_id if guild_id is not None else self.snowflake()
+
+	def snowflake(self):
+		"""A new id, increasing like Discord snowflakes"""
+		cls = MemoryBackend
+		timestamp = max(int(time.time() * 1000) - DISCORD_EPOCH, cls.last_timestamp)
+		if timestamp == cls.last_timestamp:
+			cls.increment += 1
+			if cls.increment > 0xFFF:
+				timestamp += 1
+				cls.increment = 0
+		else:
+			cls.increment = 0
+		cls.last_timestamp = timestamp
+		return (timestamp << 22) | cls.increment
+
+	def owns(self, channel):
+		return self.objects.get(getattr(channel, "id", None)) is channel
+
+	def available(self):
+		return self.connected
+
+	def refused(self, error):
+		return isinstance(error, ConnectionError) # raised before any change
+
+	def categories(self):
+		return list(self.category_list)
+
+	def channels(self, category):
+		return list(category.channels)
+
+	def get_channel(self, id):
+		return self.objects.get(id)
+
+	async def request(self, route, major, size=0):
+		"""Stands in for an API request, major is the guild or channel id the route's rate limit is keyed on"""
+		self.check_connected()
+		self.report_request(route, size)
+
+	async def create_category(self, name, reason=None):
+		await self.request(ROUTES["create_category"], self.guild_id, len(name))
+		category = MemoryCategory(self.snowflake(), name)
+		self.objects[category.id] = category
+		self.category_list.append(category)
+		return category
+
+	async def create_text_channel(self, name, category, reason=None):
+		await self.request(ROUTES["create_text_channel"], self.guild_id, len(name))
+		channel = MemoryChannel(self.snowflake(), name.lower().replace(" ", "-"), category)
+		self.objects[channel.id] = channel
+		if category is not None:
+			category.channels.append(channel)
+		return channel
+
+	async def rename_channel(self, channel, name, reason=None):
+		await self.request(ROUTES["rename_channel"], channel.id, len(name))
+		if isinstance(channel, MemoryChannel):
+			name = name.lower().replace(" ", "-")
+		channel.name = name
+
+	async def delete_channel(self, channel, reason=None):
+		await self.request(ROUTES["delete_channel"], channel.id)
+		if self.objects.pop(channel.id, None) is None:
+			raise NameError("Unknown channel: " + str(channel.id))
+		if isinstance(channel, MemoryCategory):
+			self.category_list.remove(channel)
+			for child in channel.channels: # like Discord, channels outlive their category
+				child.category = None
+		elif channel.category is not None:
+			channel.category.channels.remove(channel)
+
+	async def history(self, channel, limit=1024, before=None, after=None):
+		messages = []
+		for message in reversed(channel.messages.values()):
+			if len(messages) == limit and after is None:
+				break
+			if (before is None or message.id < before) and (after is None or message.id > after):
+				messages.append(message)
+		if after is not None:
+			messages = messages[-limit:]
+		for page in history_pages(messages, limit):
+			await self.request(ROUTES["history"], channel.id, sum(len(m.content) for m in page))
+		return messages
+
+	async def send(self, channel, content):
+		self.check_content(content)
+		await self.request(ROUTES["send"], channel.id, len(content))
+		message = MemoryMessage(self.snowflake(), channel, content)
+		channel.messages[message.id] = message
+		self.dispatch("create", channel, message.id, content)
+		return message
+
+	async def edit_message(self, message, content):
+		self.check_content(content)
+		await self.request(ROUTES["edit_message"], message.channel.id, len(content))
+		if message.id not in message.channel.messages:
+			raise NameError("Unknown message: " + str(message.id))
+		before = message.content
+		message.content = content
+		self.dispatch("edit", message.channel, message.id, content, before)
+		return message
+
+	async def delete_message(self, message):
+		await self.request(ROUTES["delete_message"], message.channel.id)
+		if message.channel.messages.pop(message.id, None) is None:
+			raise NameError("Unknown message: " + str(message.id))
+		self.dispatch("delete", message.channel, message.id, before=message.content)
+
+	async def fetch_message(self, channel, id):
+		message = channel.messages.get(id)
+		await self.request(ROUTES["fetch_message"], channel.id, len(message.content) if message is not None else 0)
+		return message
+
+	def partial_message(self, channel, id):
+		message = channel.messages.get(id)
+		if message is None:
+			raise NameError("Unknown message: " + str(id))
+		return message
+
+	def check_connected(self):
+		if not self.connected:
+			raise ConnectionError("Client is not connected")
+
+	def check_content(self, content):
+		if not isinstance(content, str) or len(content) == 0:
+			raise ValueError("Cannot send an empty message")
+		if len(content) > MAX_MESSAGE_LENGTH:
+			raise ValueError("Must be " + str(MAX_MESSAGE_LENGTH) + " or fewer in length")
@@ -0,0 +1,73 @@
+import asyncio
+from enum import Enum
+
+# Change feed for a table, built from the gateway message events forwarded to DBMS.
+# - Rows are decoded from the message content carried by the event, so no API calls are made.
+# - The WHERE clause of a subscription is evaluated locally against each decoded row.
+# - Edits of the table's record in the master table keep the subscription's headers current,
+#   deleting the record (DROP TABLE) ends the subscription.
+
+class CHANGETYPE(Enum):
+	INSERT = 0
+	UPDATE = 1
+	DELETE = 2
+
+class ChangeEvent:
+	"""A change to a row, row is None for deletes of messages the client never saw"""
+	def __init__(self, changetype, table_name, id, row=None, before=None):
+		self.type = changetype
+		self.table_name = table_name
+		self.id = id # primary key
+		self.row = row
+		self.before = before
+
+	def __repr__(self):
+		return "ChangeEvent(" + self.type.name + ", " + self.table_name + ", " + str(self.id) + ")"
+
+class Subscription:
+	"""Async iterator of ChangeEvent for one table, created by DBMS.subscribe"""
+	def __init__(self, dbms, database_id, table_id, header_id, table_name, headers, clauses):
+		self.dbms = dbms
+		self.database_id = database_id
+		self.table_id = table_id # table channel
+		self.shard_ids = set() # channels of every shard of a sharded table
+		self.header_id = header_id # record of the table in the master table
+		self.table_name = table_name
+		self.headers = headers
+		self.clauses = clauses
+		self.closed = False
+		self.queue = asyncio.Queue()
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		if self.closed and self.queue.empty():
+			raise StopAsyncIteration
+		event = await self.queue.get()
+		if event is None:
+			raise StopAsyncIteration
+		return event
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc, tb):
+		self.close()
+
+	def __len__(self):
+		"""Number of events waiting to be consumed"""
+		return self.queue.qsize()
+
+	def push(self, event):
+		if not self.closed:
+			self.queue.put_nowait(event)
+
+	def close(self):
+		"""Stops the subscription, events already queued are still delivered"""
+		if self.closed:
+			return
+		self.closed = True
+		if self in self.dbms.subscriptions:
+			self.dbms.subscriptions.remove(self)
+		self.queue.put_nowait(None)
@@ -0,0 +1,72 @@
+from .Backend import history_requests
+from .Instrumentation import milliseconds
+
+# Compaction rewrites the messages of a table so every one is a row of the table's current schema.
+# - Rows are one message each and Discord history is always in id order without gaps, so there is nothing to repack;
+#   what accumulates are messages scans pay for but can't use.
+# - Messages without a single delimiter are not rows (pinned notes, embeds, empty messages) and are deleted.
+# - Rows with more fields than the schema, where the extra fields are empty, are padding left by schema changes
+#   interrupted part way (a crashed alter_table) and are trimmed, rows with fewer fields are padded to the schema.
+#   Either kind makes every read of the table fail until it is fixed.  Rows with extra fields holding data are left
+#   alone and counted as malformed, there is no telling which field is extra.
+# - Rows are edited in place, so concurrent readers see each row either before or after its rewrite, both decoding
+#   to the same values.
+
+class CompactionReport:
+	"""What compacting a table changed and reclaimed"""
+	def __init__(self, table_name):
+		self.table_name = table_name
+		self.messages_before = 0
+		self.messages_after = 0
+		self.bytes_before = 0
+		self.bytes_after = 0
+		self.rows_rewritten = 0
+		self.malformed = 0 # rows with extra data compaction could not fix
+		self.views_rebuilt = 0
+		self.duration = 0.0
+
+	@property
+	def messages_reclaimed(self):
+		return self.messages_before - self.messages_after
+
+	@property
+	def pages_before(self):
+		return history_requests(self.messages_before)
+
+	@property
+	def pages_after(self):
+		return history_requests(self.messages_after)
+
+	@property
+	def pages_reclaimed(self):
+		"""History requests a scan of the table saves"""
+		return self.pages_before - self.pages_after
+
+	@property
+	def bytes_reclaimed(self):
+		return self.bytes_before - self.bytes_after
+
+	def __str__(self):
+		lines = ["compact " + self.table_name + " (time=" + milliseconds(self.duration) + ")"]
+		lines.append("  messages=" + str(self.messages_before) + " -> " + str(self.messages_after) + " reclaimed=" + str(self.messages_reclaimed))
+		lines.append("  pages=" + str(self.pages_before) + " -> " + str(self.pages_after) + " reclaimed=" + str(self.pages_reclaimed))
+		lines.append("  bytes=" + str(self.bytes_before) + " -> " + str(self.bytes_after) + " reclaimed=" + str(self.bytes_reclaimed))
+		lines.append("  rows rewritten=" + str(self.rows_rewritten) + " malformed=" + str(self.malformed) + " views rebuilt=" + str(self.views_rebuilt))
+		return "\n".join(lines)
+
+def repack_row(content, columns):
+	"""Content of a row fitted to a schema of columns fields, None if the message is not a row
+
+	Returns content unchanged for rows that already fit or can't be fixed."""
+	if chr(0x2502) not in content:
+		return None
+	fields = content.split(chr(0x2502))
+	if fields[-1] == "":
+		del fields[-1] # rows end with the delimiter
+	if len(fields) > columns:
+		if any(field != "" for field in fields[columns:]):
+			return content
+		fields = fields[:columns]
+	while len(fields) < columns:
+		fields.append("")
+	return chr(0x2502).join(fields) + chr(0x2502)
@@ -1,7 +1,25 @@
-import discord
 import re
+import copy
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from types import SimpleNamespace
 from enum import Enum
 from datetime import datetime
+from .Backend import Backend, DiscordBackend, history_requests
+from .QueryCache import QueryCache
+from .SQLParser import *
+from .ChangeFeed import CHANGETYPE, ChangeEvent, Subscription
+from .MaterializedView import MaterializedView
+from .Instrumentation import StatementStats, current_task, instrumented
+from .Planner import ACCESS, TableStats, plan_read
+from .Sharding import ShardMap, shard_table_name
+from .Pool import BackendPool
+from .Journal import Journal, PendingMessage
+from .Compaction import CompactionReport, repack_row
+from .Warmup import WarmReport
+from .Export import QueryIterator, write_csv, write_jsonl, columns
 
 # SDDB uses a Discord guild as a ghetto database and supports simple DB operations - create, select, update, delete.
 # The │ character ASCII(0x2502) is used as a global delimiter, and is not allowed under any circumstances.
@@ -15,62 +33,102 @@ from datetime import datetime
 # - Primary key is the message id.
 # "from" is a Python keyword and cannot be used as a variable, "against" is used instead for SQL-like syntax.
 
+JOURNAL_RETRY = 1.0 # seconds the journal waits to flush again after the backend failed
+
 class DBMS:
-	def __init__(self, discord_client, database_guild):
-		if not isinstance(discord_client, discord.Client):
-			raise TypeError("discord_client must be a discord.Client")
-		self.d = discord_client
-		self.db = None
+	def __init__(self, discord_client, database_guild=None, query_cache=None, statement_cache_size=128, instrument=None, shard_guilds=None, journal=None, schema_cache=None):
+		if query_cache is not None and not isinstance(query_cache, QueryCache):
+			raise TypeError("query_cache must be a QueryCache")
+		if schema_cache is not None and not isinstance(schema_cache, QueryCache):
+			raise TypeError("schema_cache must be a QueryCache")
+		if instrument is not None and not callable(instrument):
+			raise TypeError("instrument must be callable")
+		if journal is not None and not isinstance(journal, Journal):
+			raise TypeError("journal must be a Journal")
+		self.backend = self.connect(discord_client, database_guild)
+		self.backends = [self.backend] # backends sharded tables are spread over, the first holds the schema
+		for guild in shard_guilds or []:
+			if isinstance(guild, Backend):
+				self.backends.append(guild)
+			else:
+				self.backends.append(self.connect(discord_client, guild))
+		self.d = getattr(self.backend, "d", None) # Discord client, None for other backends
+		self.db = getattr(self.backend, "db", None) # Discord guild, None for other backends
 		self.ad = None # Active database pointer
-		if isinstance(database_guild, discord.Guild):
-			self.db = database_guild
-		elif isinstance(database_guild, int):
-			self.db = self.d.get_guild(database_guild)
-			if self.db is None:
-				raise Exception("guild does not exist: " + str(database_guild))
-		else:
-			raise TypeError("database_guild must be an int or guild object")
-		if not self.db.me.guild_permissions.administrator:
+		self.query_cache = query_cache # Opt-in, None disables result caching
+		self.schema_cache = schema_cache # Opt-in, keeps master table records between statements
+		self.schema_memo = None # master table id -> master records, shared while a schema session is open
+		self.schema_sessions = 0
+		self.subscriptions = [] # open Subscription, fed by forwarded message events
+		self.views = {} # name -> MaterializedView
+		self.table_stats = {} # table channel id -> TableStats, for planning
+		self.statement_cache = QueryCache(max_size=statement_cache_size, ttl=None) # sql text -> parsed Statement
+		self.instrument = instrument # Opt-in, called with the StatementStats of every statement
+		self.operations = {} # task -> StatementStats of the statement it is running
+		self.journal = journal # Opt-in, row writes are acknowledged once journaled and flushed in the background
+		self.journal_task = None
+		for backend in self.backends:
+			backend.add_listener(self.message_event) # backends that see their own changes report them directly
+			backend.add_monitor(self.request_event)
+		if journal is not None and len(journal) > 0 and current_task() is not None:
+			self.schedule_flush() # replay what an earlier run left, otherwise the first write or flush() does
+		if not all(backend.administrator() for backend in self.backends):
 			raise Warning("Warning: client does not have administrator permissions on database guild, CREATE and DROP operations may not be successful")
 
+	def connect(self, discord_client, guild):
+		"""Backend for a guild through a client, a Backend, or a BackendPool through a list of them"""
+		if isinstance(discord_client, (list, tuple)):
+			return BackendPool([self.connect(client, guild) for client in discord_client])
+		if isinstance(discord_client, Backend):
+			if guild is not None and guild != discord_client.guild_id:
+				raise TypeError("A Backend is bound to its guild, pass Backend objects for other guilds")
+			return discord_client
+		return DiscordBackend(discord_client, guild)
+
 	def use(self, name):
 		"""Changes the active database"""
 		if self.violates_str_rules(name) or self.violates_name_rules(name) or " " in name:
 			raise TypeError("Malformed use; illegal character")
-		for d in self.db.categories:
+		for d in self.backend.categories():
 			if d.name.lower() == name.lower():
 				self.ad = d
 				return True
 		raise NameError("No database with name")
 
+	@instrumented("create_database")
 	async def create_database(self, name):
 		"""Creates a database and sets it to the active database"""
 		if self.violates_str_rules(name) or self.violates_name_rules(name) or " " in name:
 			raise TypeError("Malformed create; illegal character")
-		for d in self.db.categories:
+		for d in self.backend.categories():
 			if d.name.lower() == name.lower():
 				raise NameError("Database with name already exists")
-		overwrites = {
-		    self.db.default_role: discord.PermissionOverwrite(read_messages=False),
-		    self.db.me: discord.PermissionOverwrite(read_messages=True)
-		    }
-		self.ad = await self.db.create_category(name, overwrites=overwrites ,reason="SDDB: New Database")
-		await self.db.create_text_channel(name, category=self.ad, reason="SDDB: New Database")
+		self.ad = await self.backend.create_category(name, reason="SDDB: New Database")
+		await self.backend.create_text_channel(name, self.ad, reason="SDDB: New Database")
 		return True
 
+	@instrumented("drop_database")
 	async def drop_database(self, name):
 		"""Drops the database"""
 		if self.violates_str_rules(name) or self.violates_name_rules(name) or " " in name:
 			raise TypeError("Malformed drop; illegal character")
-		for d in self.db.categories:
+		for d in self.backend.categories():
 			if d.name.lower() == name.lower():
-				for t in d.channels:
-					await t.delete(reason="SDDB: Drop Database")
-				await d.delete(reason="SDDB: Drop Database")
+				for t in self.backend.channels(d):
+					await self.backend.delete_channel(t, reason="SDDB: Drop Database")
+				await self.backend.delete_channel(d, reason="SDDB: Drop Database")
+				for backend in self.backends[1:]: # shards on other guilds
+					category = self.shard_category(backend, d)
+					if category is not None:
+						for t in backend.channels(category):
+							await backend.delete_channel(t, reason="SDDB: Drop Database")
+						await backend.delete_channel(category, reason="SDDB: Drop Database")
+				self.invalidate_cache(d.name)
 				self.ad = None
 				return True
 		raise NameError("Database with name does not exist")
 
+	@instrumented("alter_database")
 	async def alter_database(self, name):
 		"""Alters the database"""
 		if self.violates_str_rules(name) or self.violates_name_rules(name) or " " in name:
@@ -78,24 +136,34 @@ class DBMS:
 		if self.ad == None or (self.ad == None and use == ""):
 			raise Exception("No active database")
 
-		for d in self.db.categories:
+		for d in self.backend.categories():
 			if d.name.lower() == name.lower():
 				raise NameError("Database with name already exists")
-		for d in self.db.categories:
+		for d in self.backend.categories():
 			if d.name.lower() == self.ad.name.lower():
 				master_table = None
-				for t in self.ad.channels:
+				for t in self.backend.channels(self.ad):
 					if t.name.lower() == name.lower():
 						raise NameError("Table exists with name, rename offending table and try again")
 					if t.name.lower() == self.ad.name.lower():
 						master_table = t
-				await master_table.edit(name=name, reason="SDDB: Alter Database")
-				await d.edit(name=name, reason="SDDB: Alter Database")
+				self.invalidate_cache(d.name)
+				for backend in self.backends[1:]: # shards on other guilds
+					category = self.shard_category(backend, d)
+					if category is not None:
+						await backend.rename_channel(category, name, reason="SDDB: Alter Database")
+				await self.backend.rename_channel(master_table, name, reason="SDDB: Alter Database")
+				await self.backend.rename_channel(d, name, reason="SDDB: Alter Database")
 				self.ad = d # update the database pointer as it may have changed
 				return True
 
-	async def create_table(self, name, **kwargs):
-		"""Creates a table on the active database"""
+	@instrumented("create_table")
+	async def create_table(self, name, _shards=1, _shard_key="", **kwargs):
+		"""Creates a table on the active database, with several _shards rows are spread over channels by _shard_key
+
+		The options start with _, which no column name can, so they never collide with columns."""
+		shards = _shards
+		shard_key = _shard_key
 		if self.ad == None:
 			raise Exception("No active database")
 		if self.violates_str_rules(name) or self.violates_name_rules(name) or " " in name:
@@ -104,28 +172,47 @@ class DBMS:
 			raise NameError("master is a reserved table name")
 		if self.ad.name.lower() == name.lower():
 				raise NameError("Table cannot have same name as parent database")
-		if len(self.ad.channels) == 1024:
+		if not isinstance(shards, int) or shards < 1:
+			raise TypeError("Malformed create; shards must be a positive int")
+		if shards > 1 and (not isinstance(shard_key, str) or shard_key.lower() not in [field.lower() for field in kwargs]):
+			raise NameError("Malformed create; shard_key must be a column of the table")
+		if len(self.backend.channels(self.ad)) + shards > 1024:
 			raise Exception("Maximum number of tables reached; 1024")
 
-		table_header = ""
-
+		columns = []
 		for field in kwargs:
 			if self.violates_str_rules(field) or self.violates_name_rules(field) or field == "" or " " in field:
 				raise TypeError("Malformed create; illegal character")
 			if self.violates_datatype_rules(kwargs[field]):
 				raise TypeError("Malformed create; illegal datatype")
-			table_header = table_header + str(field) + " " + str(kwargs[field]) + chr(0x2502)
+			columns.append(str(field) + " " + str(kwargs[field]) + chr(0x2502))
+		table_header = "".join(columns)
 
 		mt = None
-		for t in self.ad.channels:
+		for t in self.backend.channels(self.ad):
 			if t.name.lower() == name.lower():
 				raise NameError("Table with name already exists")
 			if t.name.lower() == self.ad.name.lower():
 				mt = t
-		new_table = await self.db.create_text_channel(name, category=self.ad, reason="SDDB: New Table")
-		await mt.send(name + chr(0x2502) + table_header)
+		new_table = await self.backend.create_text_channel(name, self.ad, reason="SDDB: New Table")
+		header_row = await self.backend.send(mt, name + chr(0x2502) + table_header)
+		if self.schema_memo is not None and mt.id in self.schema_memo:
+			(await self.master_records(mt)).insert(0, header_row) # history is newest first
+		if shards > 1:
+			shard_map = ShardMap(name, shards, shard_key.lower(), [backend.guild_id for backend in self.backends])
+			for i in range(1, shards):
+				backend = self.shard_backend(shard_map, i)
+				category = self.shard_category(backend)
+				if category is None:
+					category = await backend.create_category(self.ad.name, reason="SDDB: New Database Shard")
+				await backend.create_text_channel(shard_map.channel_name(i), category, reason="SDDB: New Table Shard")
+			shard_row = await self.backend.send(mt, shard_map.record())
+			if self.schema_memo is not None and mt.id in self.schema_memo:
+				(await self.master_records(mt)).insert(0, shard_row)
+		self.invalidate_schema(self.ad.name)
 		return True
 
+	@instrumented("drop_table")
 	async def drop_table(self, name):
 		"""Drops the table on the active database"""
 		if self.ad == None:
@@ -136,20 +223,37 @@ class DBMS:
 			raise NameError("Cannot drop table; illegal operation")
 		table = None
 		master_table = None
-		for t in self.ad.channels:
+		for t in self.backend.channels(self.ad):
 			if t.name.lower() == name.lower():
 				table = t
 			if t.name.lower() == self.ad.name.lower():
 				master_table = t
 		if table == None:
 			raise NameError("Table with name does not exist")
-		for record in await master_table.history(limit=1024).flatten():
+		mt_records = await self.master_records(master_table)
+		shard_map = self.find_shard_map(mt_records, name)
+		shards = self.table_shards(table, shard_map)
+		for record in mt_records:
 			if record.content.split(chr(0x2502))[0].lower() == table.name.lower():
-				await record.delete()
+				await self.backend.delete_message(record)
+				if self.schema_memo is not None:
+					mt_records.remove(record)
 				break
-		await table.delete(reason="SDDB: Drop Table")
+		if shard_map is not None:
+			await self.backend.delete_message(shard_map.message)
+			if self.schema_memo is not None:
+				mt_records.remove(shard_map.message)
+			for shard in shards[1:]:
+				await self.backend_of(shard).delete_channel(shard, reason="SDDB: Drop Table")
+				self.table_stats.pop(shard.id, None)
+		await self.backend.delete_channel(table, reason="SDDB: Drop Table")
+		self.table_stats.pop(table.id, None)
+		self.stale_views(table.id)
+		self.invalidate_cache(self.ad.name, name)
+		self.invalidate_schema(self.ad.name)
 		return True
 
+	@instrumented("alter_table")
 	async def alter_table(self, name, add="", drop="", modify="", rename=""):
 		"""Alters a table on the active database"""
 		if self.ad == None:
@@ -164,9 +268,10 @@ class DBMS:
 		headers = None
 		table = None
 		header_row = None
-		for t in self.ad.channels:
+		for t in self.backend.channels(self.ad):
 			if t.name.lower() == self.ad.name.lower():
-				mt_records = await t.history(limit=1024).flatten()
+				mt_records = await self.master_records(t)
+				shard_map = self.find_shard_map(mt_records, name)
 				for record in mt_records:
 					if name.lower() == record.content.split(chr(0x2502))[0]:
 						headers = self.build_table_headers(record)
@@ -185,32 +290,34 @@ class DBMS:
 				raise NameError("Malformed alter; illegal character")
 			if self.violates_datatype_rules(new_col[1]):
 				raise TypeError("Malformed alter; illegal datatype")
-			await header_row.edit(content=header_row.content + new_col[0] + " " + new_col[1] + chr(0x2502))
-			for row in await table.history(limit=1024).flatten():
-				await row.edit(content=row.content + "" + chr(0x2502))
+			await self.backend.edit_message(header_row, header_row.content + new_col[0] + " " + new_col[1] + chr(0x2502))
+			for shard in self.table_shards(table, shard_map):
+				raw_rows = await self.scan_table(shard)
+				self.record_rows(scanned=len(raw_rows))
+				for row in raw_rows:
+					await self.edit_row(row, row.content + "" + chr(0x2502))
 			successful = True
 
 		# drop
 		if drop != "":
 			if self.violates_name_rules(drop):
 				raise NameError("Malformed alter; illegal character")
+			if shard_map is not None and drop.lower() == shard_map.key.lower():
+				raise NameError("Cannot drop shard key " + drop)
 			column_exists = False
 			for i in range(len(headers)):
 				if headers[i].column_name.lower() == drop.lower():
 					column_exists = True
 					fractured_header = header_row.content.split(chr(0x2502))
-					rebuilt_header = ""
-					for x in range(len(fractured_header)):
-						if x-1 != i:
-							rebuilt_header += fractured_header[x] + chr(0x2502)
-					await header_row.edit(content=rebuilt_header[:-1])
-					for row in await table.history(limit=1024).flatten():
-						fractured_row = row.content.split(chr(0x2502))
-						rebuilt_row = ""
-						for x in range(len(fractured_row)):
-							if x != i:
-								rebuilt_row += fractured_row[x] + chr(0x2502)
-						await row.edit(content=rebuilt_row[:-1])
+					rebuilt_header = chr(0x2502).join(fractured_header[x] for x in range(len(fractured_header)) if x-1 != i)
+					await self.backend.edit_message(header_row, rebuilt_header)
+					for shard in self.table_shards(table, shard_map):
+						raw_rows = await self.scan_table(shard)
+						self.record_rows(scanned=len(raw_rows))
+						for row in raw_rows:
+							fractured_row = row.content.split(chr(0x2502))
+							rebuilt_row = chr(0x2502).join(fractured_row[x] for x in range(len(fractured_row)) if x != i)
+							await self.edit_row(row, rebuilt_row)
 					successful = True
 			if not column_exists:
 				raise NameError("No column with name " + drop)
@@ -232,7 +339,9 @@ class DBMS:
 			if header_exits:
 				fractured_header = header_row.content.split(mod_col[0], 1)
 				fractured_header[1] = chr(0x2502) + fractured_header[1].split(chr(0x2502), 1)[1]
-				await header_row.edit(content=fractured_header[0] + mod_col[1] + " " + mod_col[2] + fractured_header[1])
+				await self.backend.edit_message(header_row, fractured_header[0] + mod_col[1] + " " + mod_col[2] + fractured_header[1])
+				if shard_map is not None and mod_col[0].lower() == shard_map.key.lower():
+					await self.backend.edit_message(shard_map.message, ShardMap(shard_map.table_name, shard_map.count, mod_col[1].lower(), shard_map.guild_ids).record())
 				successful = True
 			else:
 				raise NameError("No column with name " + mod_col[0])
@@ -241,29 +350,37 @@ class DBMS:
 		if rename != "":
 			if self.ad.name.lower() == rename.lower():
 				raise NameError("Table cannot have same name as parent database")
-			for t in self.ad.channels:
+			for t in self.backend.channels(self.ad):
 				if t.name.lower() == rename.lower():
 					raise NameError("Table with name already exists")
-			new_headers = ""
-			for header in header_row.content.split(chr(0x2502)):
-				if header.lower() == name.lower():
-					header = rename
-				new_headers += header + chr(0x2502)
-			await header_row.edit(content=new_headers[:-1])
-			await table.edit(name=rename, reason="SDDB: Alter Table")
+			new_headers = [rename if header.lower() == name.lower() else header for header in header_row.content.split(chr(0x2502))]
+			await self.backend.edit_message(header_row, chr(0x2502).join(new_headers))
+			if shard_map is not None:
+				shards = self.table_shards(table, shard_map)
+				renamed = ShardMap(rename, shard_map.count, shard_map.key, shard_map.guild_ids)
+				for i in range(1, len(shards)):
+					await self.backend_of(shards[i]).rename_channel(shards[i], renamed.channel_name(i), reason="SDDB: Alter Table")
+				await self.backend.edit_message(shard_map.message, renamed.record())
+			await self.backend.rename_channel(table, rename, reason="SDDB: Alter Table")
 			successful = True
 
 		if successful:
+			self.invalidate_cache(self.ad.name, name)
+			self.invalidate_schema(self.ad.name)
+			self.stale_views(table.id)
+			if rename != "":
+				self.invalidate_cache(self.ad.name, rename)
 			return True
 		return False
 
-	async def query(self, select="*", against="", where="", use=""):
-		"""Queries the active database"""
+	@instrumented("query")
+	async def query(self, select="*", against="", where="", use="", analyze=False):
+		"""Queries the active database, with analyze the returned Table carries the StatementStats of the query"""
 		if self.ad == None or (self.ad == None and use == ""):
 			raise Exception("No active database")
-		if not isinstance(select, str) or not isinstance(against, str) or not isinstance(use, str) or not isinstance(where, str):
+		if not isinstance(select, str) or not isinstance(against, str) or not isinstance(use, str) or not isinstance(where, (str, Clause)):
 			raise TypeError("Malformed query; unexpected datatype, str only")
-		if self.violates_str_rules(select, against, where, use):
+		if self.violates_str_rules(select, against, self.clause_text(where), use):
 			raise TypeError("Malformed query; illegal character")
 		if select is "":
 			raise NameError("Malformed query; invalid SELECT")
@@ -272,11 +389,23 @@ class DBMS:
 
 		adstore = self.change_ad_pointer(use)
 
+		cache_key = None
+		if self.query_cache is not None:
+			cache_key = self.query_cache_key(select, against, where)
+			cached = self.query_cache.get(cache_key)
+			if cached is not None:
+				self.record_rows(returned=len(cached.rows))
+				if adstore is not None:
+					self.change_ad_pointer(adstore)
+				return cached.copy()
+			cache_version = self.query_cache.version(cache_key[0], cache_key[1]) # before reading, see QueryCache.put
+
 		headers = None
 		table = None
-		for t in self.ad.channels:
+		for t in self.backend.channels(self.ad):
 			if t.name.lower() == self.ad.name.lower():
-				mt_records = await t.history(limit=1024).flatten()
+				mt_records = await self.master_records(t)
+				shard_map = self.find_shard_map(mt_records, against)
 				for record in mt_records:
 					if against.lower() == record.content.split(chr(0x2502))[0]:
 						headers = self.build_table_headers(record)
@@ -300,17 +429,29 @@ class DBMS:
 					selected_cols.append(i)
 					selectables.remove(headers[i].column_name.lower())
 			if len(selectables) > 0:
-				invalid_selected = ""
-				for s in selectables:
-					invalid_selected += " " + s
+				invalid_selected = "".join(" " + s for s in selectables)
 				if adstore is not None:
 					self.change_ad_pointer(adstore)
 				raise Exception("Malformed query; selected columns not in table headers," + invalid_selected)
 
-		rawrows = await table.history(limit=1024).flatten()
-		full_table = Table(against, headers, rawrows)
-		match_table = Table(against, headers)
 		clauses = self.parse_where(where)
+		plan = None
+		if shard_map is None:
+			plan = self.plan_table("select", table, against, clauses[0])
+		if plan is not None and plan.access == ACCESS.MATERIALIZED_VIEW:
+			rows = []
+			for id in sorted(plan.view.rows, reverse=True): # newest first like the table channel history
+				rows.append(TableRow(headers, table_records=[copy.copy(r) for r in plan.view.rows[id].records]))
+			full_table = Table(against, headers, table_rows=rows)
+		else:
+			if plan is not None:
+				rawrows = await self.read_rows(table, plan)
+			else:
+				rawrows = await self.read_shards(self.prune_shards(self.table_shards(table, shard_map), shard_map, headers, clauses[0]), "select", against, clauses[0])
+			start = time.perf_counter()
+			full_table = Table(against, headers, rawrows)
+			self.record_rows(scanned=len(rawrows), decode_time=time.perf_counter() - start)
+		match_table = Table(against, headers)
 		for row in full_table.rows:
 			for clause in clauses: # TODO: this will need to be changed to support and/or operators
 				if self.match_where(clause, row):
@@ -330,12 +471,21 @@ class DBMS:
 				selected_rows.append(TableRow(selected_headers, table_records=selected_records))
 			match_table = Table(against, selected_headers, table_rows=selected_rows)
 
+		self.record_rows(returned=len(match_table.rows))
+		if cache_key is not None:
+			self.query_cache.put(cache_key, match_table.copy(), cache_version)
+
 		# cleanup
 		if adstore is not None:
 			self.change_ad_pointer(adstore)
 
 		return match_table
 
+	def query_iter(self, select="*", against="", where="", use=""):
+		"""Returns a QueryIterator over the rows of a query, the query runs on the first row or export"""
+		return QueryIterator(lambda: self.query(select, against, where, use), against)
+
+	@instrumented("insert_into")
 	async def insert_into(self, against, use="", **kwargs):
 		"""Insert a row into a table"""
 		if self.ad == None or (self.ad == None and use == ""):
@@ -349,9 +499,10 @@ class DBMS:
 
 		table = None
 		headers = None
-		for t in self.ad.channels:
+		for t in self.backend.channels(self.ad):
 			if t.name.lower() == self.ad.name.lower():
-				mt_records = await t.history(limit=1024).flatten()
+				mt_records = await self.master_records(t)
+				shard_map = self.find_shard_map(mt_records, against)
 				for record in mt_records:
 					if against.lower() == record.content.split(chr(0x2502))[0].lower():
 						headers = self.build_table_headers(record)
@@ -367,10 +518,6 @@ class DBMS:
 			if adstore is not None:
 				self.change_ad_pointer(adstore)
 			raise Exception("Number of columns exceeds table definition")
-		if len(await table.history(limit=1024).flatten()) == 1024:
-			if adstore is not None:
-				self.change_ad_pointer(adstore)
-			raise Exception("Maximum number of records reached; 1024")
 
 		new_row = TableRow(headers)
 		for field in kwargs:
@@ -383,7 +530,22 @@ class DBMS:
 				if adstore is not None:
 					self.change_ad_pointer(adstore)
 				raise NameError("No field \"" + field + "\" exists on table")
-		await table.send(str(new_row))
+
+		if shard_map is not None: # the row goes to the shard of its shard key
+			for i in range(len(headers)):
+				if headers[i].column_name.lower() == shard_map.key.lower():
+					table = self.table_shards(table, shard_map)[shard_map.shard(new_row.records[i].data, headers[i].datatype)]
+		raw_rows = await self.scan_table(table)
+		self.record_rows(scanned=len(raw_rows))
+		if len(raw_rows) == 1024:
+			if adstore is not None:
+				self.change_ad_pointer(adstore)
+			raise Exception("Maximum number of records reached; 1024")
+		message = await self.send_row(table, str(new_row))
+		self.record_rows(returned=1)
+		self.table_stats_change(table.id, message.id, True)
+		self.view_change(table.id, message.id, message.content)
+		self.invalidate_cache(self.ad.name, against)
 
 		# cleanup
 		if adstore is not None:
@@ -391,22 +553,24 @@ class DBMS:
 
 		return True
 
+	@instrumented("update")
 	async def update(self, against, where="", use="", **kwargs):
 		"""Update a row in a table"""
 		if self.ad == None or (self.ad == None and use == ""):
 			raise Exception("No active database")
-		if not isinstance(against, str) or not isinstance(use, str) or not isinstance(where, str):
+		if not isinstance(against, str) or not isinstance(use, str) or not isinstance(where, (str, Clause)):
 			raise TypeError("Malformed update; table or use must be a str")
-		if self.violates_str_rules(against, use, where) or self.violates_name_rules(against):
+		if self.violates_str_rules(against, use, self.clause_text(where)) or self.violates_name_rules(against):
 			raise TypeError("Malformed update; illegal character")
 
 		adstore = self.change_ad_pointer(use)
 
 		table = None
 		headers = None
-		for t in self.ad.channels:
+		for t in self.backend.channels(self.ad):
 			if t.name.lower() == self.ad.name.lower():
-				mt_records = await t.history(limit=1024).flatten()
+				mt_records = await self.master_records(t)
+				shard_map = self.find_shard_map(mt_records, against)
 				for record in mt_records:
 					if against.lower() == record.content.split(chr(0x2502))[0]:
 						headers = self.build_table_headers(record)
@@ -422,8 +586,17 @@ class DBMS:
 				self.change_ad_pointer(adstore)
 			raise Exception("Number of columns exceeds table definition")
 
+		if shard_map is not None:
+			for field in kwargs:
+				if field.lower() == shard_map.key.lower():
+					if adstore is not None:
+						self.change_ad_pointer(adstore)
+					raise Exception("Cannot update shard key " + field + "; delete and insert the row instead")
+
 		# generate row objects from raw
-		raw_rows = await table.history(limit=1024).flatten()
+		clauses = self.parse_where(where)
+		raw_rows = await self.read_shards(self.prune_shards(self.table_shards(table, shard_map), shard_map, headers, clauses[0]), "update", against, clauses[0])
+		start = time.perf_counter()
 		rows = []
 		for raw in raw_rows:
 			tr = TableRow(headers)
@@ -433,8 +606,8 @@ class DBMS:
 			for i in range(len(split_rows)):
 				tr.update_record(i+1, split_rows[i])
 			rows.append(tr)
+		self.record_rows(scanned=len(raw_rows), decode_time=time.perf_counter() - start)
 		
-		clauses = self.parse_where(where)
 		for i in range(len(rows)):
 			for clause in clauses: # TODO: this will need to be changed to support and/or operators
 				if self.match_where(clause, rows[i]):
@@ -451,9 +624,13 @@ class DBMS:
 				else:
 					rows[i] = None
 
-		for i in range(len(rows)):
-			if rows[i] is not None:
-				await raw_rows[i].edit(content=rows[i].writable())
+		async def edit(change):
+			raw, row = change
+			await self.edit_row(raw, row.writable())
+			self.record_rows(returned=1)
+			self.view_change(raw.channel.id, raw.id, row.writable())
+		await self.write_rows(edit, [(raw_rows[i], rows[i]) for i in range(len(rows)) if rows[i] is not None])
+		self.invalidate_cache(self.ad.name, against)
 
 		# cleanup
 		if adstore is not None:
@@ -461,22 +638,101 @@ class DBMS:
 
 		return True
 
+	async def subscribe(self, against, where="", use=""):
+		"""Subscribes to changes to rows in a table matching the where clause, returns a Subscription
+
+		Reads the schema once, events are then decoded from forwarded message events without any API calls"""
+		if self.ad == None or (self.ad == None and use == ""):
+			raise Exception("No active database")
+		if not isinstance(against, str) or not isinstance(use, str) or not isinstance(where, (str, Clause)):
+			raise TypeError("Malformed subscribe; table or use must be a str")
+		if self.violates_str_rules(against, use, self.clause_text(where)) or self.violates_name_rules(against):
+			raise TypeError("Malformed subscribe; illegal character")
+
+		adstore = self.change_ad_pointer(use)
+		database = self.ad
+		try:
+			table, headers, header_row, shard_map = await self.find_table(against)
+			shards = self.table_shards(table, shard_map)
+		finally:
+			if adstore is not None:
+				self.change_ad_pointer(adstore)
+
+		clauses = self.parse_where(where)
+		self.check_clauses(headers, clauses) # a clause that can't be evaluated would fail on every event
+		subscription = Subscription(self, database.id, table.id, header_row.id, against, headers, clauses)
+		if shard_map is not None:
+			subscription.shard_ids = set(shard.id for shard in shards)
+		self.subscriptions.append(subscription)
+		return subscription
+
+	@instrumented("create_materialized_view")
+	async def create_materialized_view(self, name, query, use=""):
+		"""Creates an in memory view of a SELECT on the active database, kept current from writes and message events"""
+		if self.ad == None or (self.ad == None and use == ""):
+			raise Exception("No active database")
+		if not isinstance(name, str) or not isinstance(use, str):
+			raise TypeError("Malformed create; name or use must be a str")
+		if self.violates_str_rules(name, use) or self.violates_name_rules(name) or " " in name:
+			raise TypeError("Malformed create; illegal character")
+		if name.lower() in self.views:
+			raise NameError("View with name already exists")
+		if isinstance(query, str):
+			query = self.prepare(query).statement
+		if not isinstance(query, SelectStatement):
+			raise TypeError("query must be a SELECT statement")
+		if query.params:
+			raise TypeError("Statement has unbound parameters")
+
+		adstore = self.change_ad_pointer(use)
+		view = MaterializedView(name.lower(), query, self.ad.id)
+		try:
+			await self.load_view(view)
+		finally:
+			if adstore is not None:
+				self.change_ad_pointer(adstore)
+		self.views[view.name] = view
+		return True
+
+	def drop_materialized_view(self, name):
+		"""Drops a materialized view"""
+		if not isinstance(name, str):
+			raise TypeError("name must be a str")
+		if name.lower() not in self.views:
+			raise NameError("No view with name: " + name)
+		del self.views[name.lower()]
+		return True
+
+	@instrumented("read_materialized_view")
+	async def read_materialized_view(self, name):
+		"""Returns the contents of a materialized view as a Table, API calls are only made if the view is stale"""
+		if not isinstance(name, str):
+			raise TypeError("name must be a str")
+		view = self.views.get(name.lower())
+		if view is None:
+			raise NameError("No view with name: " + name)
+		if view.stale:
+			await self.load_view(view)
+		return self.view_table(view)
+
+	@instrumented("delete")
 	async def delete(self, against, where="", use=""):
 		"""Delete row(s) in a table"""
 		if self.ad == None or (self.ad == None and use == ""):
 			raise Exception("No active database")
-		if not isinstance(against, str) or not isinstance(use, str) or not isinstance(where, str):
+		if not isinstance(against, str) or not isinstance(use, str) or not isinstance(where, (str, Clause)):
 			raise TypeError("Malformed delete; table or use must be a str")
-		if self.violates_str_rules(against, use, where) or self.violates_name_rules(against):
+		if self.violates_str_rules(against, use, self.clause_text(where)) or self.violates_name_rules(against):
 			raise TypeError("Malformed delete; illegal character")
 
 		adstore = self.change_ad_pointer(use)
 
 		table = None
 		headers = None
-		for t in self.ad.channels:
+		for t in self.backend.channels(self.ad):
 			if t.name.lower() == self.ad.name.lower():
-				mt_records = await t.history(limit=1024).flatten()
+				mt_records = await self.master_records(t)
+				shard_map = self.find_shard_map(mt_records, against)
 				for record in mt_records:
 					if against.lower() == record.content.split(chr(0x2502))[0]:
 						headers = self.build_table_headers(record)
@@ -489,7 +745,9 @@ class DBMS:
 			raise NameError("No table with name: " + against)
 
 		# generate row objects from raw
-		raw_rows = await table.history(limit=1024).flatten()
+		clauses = self.parse_where(where)
+		raw_rows = await self.read_shards(self.prune_shards(self.table_shards(table, shard_map), shard_map, headers, clauses[0]), "delete", against, clauses[0])
+		start = time.perf_counter()
 		rows = []
 		for raw in raw_rows:
 			tr = TableRow(headers)
@@ -499,8 +757,8 @@ class DBMS:
 			for i in range(len(split_rows)):
 				tr.update_record(i+1, split_rows[i])
 			rows.append(tr)
+		self.record_rows(scanned=len(raw_rows), decode_time=time.perf_counter() - start)
 		
-		clauses = self.parse_where(where)
 		for i in range(len(rows)):
 			for clause in clauses: # TODO: this will need to be changed to support and/or operators
 				if self.match_where(clause, rows[i]):
@@ -508,11 +766,16 @@ class DBMS:
 				else:
 					rows[i] = None
 
-		successful = False
-		for i in range(len(rows)):
-			if rows[i] is not None:
-				await raw_rows[i].delete()
-				successful = True
+		async def remove(raw):
+			await self.delete_row(raw)
+			self.record_rows(returned=1)
+			self.table_stats_change(raw.channel.id, raw.id, False)
+			self.view_change(raw.channel.id, raw.id, None)
+		deletes = [raw_rows[i] for i in range(len(rows)) if rows[i] is not None]
+		successful = len(deletes) > 0
+		await self.write_rows(remove, deletes)
+		if successful:
+			self.invalidate_cache(self.ad.name, against)
 
 		# cleanup
 		if adstore is not None:
@@ -522,169 +785,937 @@ class DBMS:
 			return True
 		return False
 
-	async def sql(self, sql):
+	@instrumented("compact")
+	async def compact(self, name, use="", pace=0.0):
+		"""Rewrites a table so every message is a row of its current schema, returns a CompactionReport
+
+		Deletes messages that are not rows, trims and pads rows to the schema, then rebuilds the table's stats and the
+		materialized views over it.  Readers are not blocked, pace is seconds to wait between writes."""
+		if not isinstance(name, str) or not isinstance(use, str):
+			raise TypeError("Malformed compact; table or use must be a str")
+		if self.violates_str_rules(name, use) or self.violates_name_rules(name):
+			raise TypeError("Malformed compact; illegal character")
+		database = self.ad # resolved once, the active database may change while a background compaction runs
+		if use != "":
+			database = None
+			for d in self.backend.categories():
+				if d.name.lower() == use.lower():
+					database = d
+		if database is None:
+			raise Exception("No active database")
+		start = time.perf_counter()
+		table, headers, header_row, shard_map = await self.find_table(name, database)
+		report = CompactionReport(name)
+		columns = len(headers) - 1 # id is not stored
+		for shard in self.table_shards(table, shard_map, database):
+			raw_rows = await self.scan_table(shard)
+			self.record_rows(scanned=len(raw_rows))
+			report.messages_before += len(raw_rows)
+			for raw in reversed(raw_rows): # oldest first, in id order
+				report.bytes_before += len(raw.content)
+				content = repack_row(raw.content, columns)
+				if content is None:
+					await self.delete_row(raw)
+					self.table_stats_change(shard.id, raw.id, False)
+				else:
+					report.messages_after += 1
+					report.bytes_after += len(content)
+					if len(content.split(chr(0x2502))) - 1 != columns:
+						report.malformed += 1
+						continue
+					if content == raw.content:
+						continue
+					await self.edit_row(raw, content)
+					report.rows_rewritten += 1
+				self.record_rows(returned=1)
+				if pace > 0:
+					await asyncio.sleep(pace) # leave rate limit budget to foreground statements
+		self.invalidate_cache(database.name, name)
+		for view in list(self.views.values()):
+			if view.table_id == table.id:
+				await self.load_view(view)
+				report.views_rebuilt += 1
+		report.duration = time.perf_counter() - start
+		return report
+
+	def compact_in_background(self, name, use="", pace=0.5):
+		"""Starts compacting a table in its own task, returns the task, its result is the CompactionReport"""
+		return asyncio.ensure_future(self.compact(name, use, pace))
+
+	@instrumented("warm")
+	async def warm(self, databases=None, tables=None, concurrency=4):
+		"""Reads the master tables of databases into the schema cache and the rows of tables into the query cache
+		concurrently, returns a WarmReport
+
+		databases is a list of database names, every database by default.  tables is a list of table names, of the
+		active database or as database.table.  At most concurrency reads run at once.  Databases are skipped without a
+		schema_cache and tables without a query_cache, there would be nowhere to keep them."""
+		if (databases is not None and not all(isinstance(d, str) for d in databases)) or (tables is not None and not all(isinstance(t, str) for t in tables)):
+			raise TypeError("Malformed warm; databases and tables must be lists of str")
+		if not isinstance(concurrency, int) or concurrency < 1:
+			raise ValueError("concurrency must be a positive int")
+		if self.schema_cache is None and self.query_cache is None:
+			raise ValueError("Nothing to warm; DBMS has no schema_cache or query_cache")
+		start = time.perf_counter()
+		report = WarmReport()
+		masters = {} # database name -> master table read
+		keys = {} # database.table -> query cache key of the rows read
+		categories = {}
+		for d in self.backend.categories():
+			categories[d.name.lower()] = d
+
+		async def attempt(name, coroutine):
+			try:
+				await coroutine
+			except Exception as e: # reported, the rest still loads
+				report.errors[name] = str(e)
+
+		async def warm_schema(database):
+			for t in self.backend.channels(database):
+				if t.name.lower() == database.name.lower():
+					report.schemas[database.name] = len(await self.master_records(t))
+					masters[database.name] = t
+					return
+			raise NameError("No master table for database: " + database.name)
+
+		async def warm_table(database, name):
+			key = self.query_cache_key("*", name, "", database)
+			version = self.query_cache.version(key[0], key[1]) # before reading, see QueryCache.put
+			table, headers, header_row, shard_map = await self.find_table(name, database)
+			shards = self.table_shards(table, shard_map, database)
+			raw_rows = []
+			for shard in shards:
+				raw_rows.extend(await self.scan_table(shard))
+			raw_rows.sort(key=lambda message: message.id, reverse=True)
+			self.record_rows(scanned=len(raw_rows))
+			self.query_cache.put(key, Table(name, headers, raw_rows), version)
+			for view in list(self.views.values()):
+				if view.stale and view.table_id == table.id:
+					await self.load_view(view)
+					report.views_reloaded += 1
+			report.tables[database.name + "." + name] = len(raw_rows)
+			keys[database.name + "." + name] = key
+
+		loads = []
+		if databases is None:
+			for d in categories.values():
+				if self.schema_cache is None:
+					break
+				if any(t.name.lower() == d.name.lower() for t in self.backend.channels(d)): # skip categories that are not databases
+					loads.append(attempt(d.name, warm_schema(d)))
+		else:
+			for name in databases:
+				if self.schema_cache is None:
+					report.skipped[name] = "DBMS has no schema_cache"
+				elif name.lower() in categories:
+					loads.append(attempt(name, warm_schema(categories[name.lower()])))
+				else:
+					report.errors[name] = "No database with name: " + name
+		for name in tables if tables is not None else []:
+			if self.query_cache is None:
+				report.skipped[name] = "DBMS has no query_cache"
+				continue
+			database = self.ad
+			if "." in name:
+				database = categories.get(name.split(".", 1)[0].lower())
+				if database is None:
+					report.errors[name] = "No database with name: " + name.split(".", 1)[0]
+					continue
+				name = name.split(".", 1)[1]
+			elif database is None:
+				report.errors[name] = "No active database"
+				continue
+			loads.append(attempt(database.name + "." + name, warm_table(database, name)))
+		with self.schema_session(): # tables share the master table reads of their database
+			await self.fan_out(loads, concurrency)
+		for name, master_table in masters.items(): # evicted, or changed while warming up
+			if not self.schema_cached(master_table):
+				report.skipped[name] = "not kept in the schema cache"
+				del report.schemas[name]
+		for name, key in keys.items():
+			if key not in self.query_cache:
+				report.skipped[name] = "not kept in the query cache"
+				del report.tables[name]
+		report.duration = time.perf_counter() - start
+		return report
+
+	def prepare(self, sql):
+		"""Parses sql into a PreparedStatement, parsed statements are cached by their text"""
 		if not isinstance(sql, str):
 			raise TypeError("sql must be a str")
-		sql = sql.lower()
-		sql = sql.replace("\n", " ")
+		statement = self.statement_cache.get(sql)
+		if statement is None:
+			statement = parse(sql)
+			self.statement_cache.put(sql, statement)
+		return PreparedStatement(self, sql, statement)
+
+	async def sql(self, sql, params=None):
+		"""Parses and runs sql, values for ? or :name placeholders are taken from params"""
+		return await self.prepare(sql).execute(params)
+
+	@instrumented("sql")
+	async def run_statement(self, statement):
+		"""Runs a parsed Statement"""
+		if statement.params:
+			raise TypeError("Statement has unbound parameters")
 
-		if sql.startswith("use"):
-			return self.use(sql.split(" ", 1)[1])
+		if isinstance(statement, UseStatement):
+			return self.use(statement.name)
 
-		if sql.startswith("create database"):
-			return await self.create_database(sql.split(" ", 2)[2])
+		if isinstance(statement, CreateDatabaseStatement):
+			return await self.create_database(statement.name)
 
-		if sql.startswith("drop database"):
-			return await self.drop_database(sql.split(" ", 2)[2])
+		if isinstance(statement, DropDatabaseStatement):
+			return await self.drop_database(statement.name)
 
-		if sql.startswith("alter database"):
-			return await self.alter_database(sql.split(" ", 2)[2])
+		if isinstance(statement, AlterDatabaseStatement):
+			return await self.alter_database(statement.name)
 
-		if sql.startswith("create table"):
-			sql = sql.replace("create table ", "", 1)
-			name = sql.split(" ", 1)[0]
-			sql = sql.replace(name + " ", "", 1)
-			sql = sql.replace("(", "")
-			sql = sql.replace(")", "")
-			sql = sql.replace(";", "")
-			sql = sql.replace(", ", ",")
+		if isinstance(statement, CreateTableStatement):
 			kwargs = {}
-			for k in sql.split(","):
-				kwargs[k.split(" ")[0]] = k.split(" ")[1]
-			return await self.create_table(name=name, **kwargs)
-
-		if sql.startswith("drop table"):
-			return await self.drop_table(sql.split(" ", 2)[2])
-
-		if sql.startswith("alter table"):
-			sql = sql.replace("alter table ", "", 1)
-			name = sql.split(" ", 1)[0]
-			sql = sql.replace(name, "", 1)
-			operations = sql.split(",")
-
-			adds, drops, modifys, renames = [], [], [], []
-			for op in operations:
-				if op.startswith(" "):
-					op = op.replace(" ", "", 1)
-				if op.startswith("add column"):
-					adds.append(op.split("add column ", 1)[1])
-				elif op.startswith("add"):
-					adds.append(op.split("add ", 1)[1])
-				elif op.startswith("drop column"):
-					drops.append(op.split("drop column ", 1)[1])
-				elif op.startswith("drop"):
-					drops.append(op.split("drop ", 1)[1])
-				elif op.startswith("modify column"):
-					modifys.append(op.split("modify column ", 1)[1])
-				elif op.startswith("modify"):
-					modifys.append(op.split("modify ", 1)[1])
-				elif op.startswith("rename"):
-					renames.append(op.split("rename ", 1)[1])
+			for column, datatype in statement.columns:
+				kwargs[column] = datatype
+			return await self.create_table(statement.name, _shards=statement.shards, _shard_key=statement.shard_key, **kwargs)
 
+		if isinstance(statement, DropTableStatement):
+			return await self.drop_table(statement.name)
+
+		if isinstance(statement, Script):
+			return await self.run_script(statement)
+
+		if isinstance(statement, ExplainStatement):
+			plan = await self.explain(statement.statement)
+			if statement.analyze:
+				result, plan.actual = await self.analyze_statement(statement.statement)
+			return plan
+
+		if isinstance(statement, AlterTableStatement):
+			renames = [op for op in statement.operations if op[0] == "rename"]
 			if len(renames) > 1:
 				raise Exception("Malformed modify; too many renames")
 
-			adds_results, drops_results, modifys_results, renames_results = [], [], [], []
-			for add in adds:
-				try:
-					adds_results.append(await self.alter_table(name=name, add=add))
-				except Exception as e:
-					adds_results.append(str(e))
-			for drop in drops:
-				try:
-					drops_results.append(await self.alter_table(name=name, drop=drop))
-				except Exception as e:
-					drops_results.append(str(e))
-			for modify in modifys:
-				try:
-					modifys_results.append(await self.alter_table(name=name, modify=modify))
-				except Exception as e:
-					modifys_results.append(str(e))
-			for rename in renames:
-				try:
-					renames_results.append(await self.alter_table(name=name, rename=rename))
-				except Exception as e:
-					renames_results.append(str(e))
-
-			results_str = ""
-			for i in range(len(adds_results)):
-				results_str += "add column " + adds[i] + ": " + str(adds_results[i])+ "\n"
-			for i in range(len(drops_results)):
-				results_str += "drop column " + drops[i] + ": " + str(drops_results[i])+ "\n"
-			for i in range(len(modifys_results)):
-				results_str += "modify column " + modifys[i] + ": " + str(modifys_results[i])+ "\n"
-			for i in range(len(renames_results)):
-				results_str += "rename " + renames[i] + ": " + str(renames_results[i])+ "\n"
-			return results_str
-
-		if sql.startswith("select"):
-			sql = sql.replace("select ", "", 1)
-			select = ""
-			if " from " in sql:
-				select = sql.split(" from ", 1)[0]
-				sql = sql.split(" from ", 1)[1]
-			elif " against " in sql:
-				select = sql.split(" against ", 1)[0]
-				sql= sql.split(" against ", 1)[1]
-			else:
-				raise NameError("Malformed query; invalid AGAINST (FROM)")
-			sql = sql.replace(select, "", 1)
-			against = sql.split(" where", 1)[0]
-			sql = sql.replace(against, "", 1)
-			sql = sql.replace("where ", "", 1)
-			sql = sql[1:]
-			return await self.query(select=select, against=against, where=sql)
-			
-		if sql.startswith("insert into"):
-			sql = sql.replace("insert into ", "", 1)
-			against = sql.split(" ", 1)[0]
-			sql = sql.replace(against, "", 1)
-			sql = sql.replace("(", "")
-			sql = sql.replace(")", "")
-			sql = sql.replace(";", "")
-			columns = sql.split(" values ")[0]
-			columns = columns.split(",")
-			values = sql.split(" values ")[1]
-			values = values.split(",")
+			results = []
+			with self.schema_session(): # every operation shares one read of the master table
+				for action in ["add", "drop", "modify", "rename"]: # renames last so earlier operations find the table
+					for op in statement.operations:
+						if op[0] != action:
+							continue
+						try:
+							results.append((op, await self.alter_table(name=statement.name, **{action: op[1]})))
+						except Exception as e:
+							results.append((op, str(e)))
+
+			labels = {"add": "add column ", "drop": "drop column ", "modify": "modify column ", "rename": "rename "}
+			return "".join(labels[op[0]] + op[1] + ": " + str(result) + "\n" for op, result in results)
+
+		if isinstance(statement, CreateMaterializedViewStatement):
+			return await self.create_materialized_view(statement.name, statement.select)
+
+		if isinstance(statement, DropMaterializedViewStatement):
+			return self.drop_materialized_view(statement.name)
+
+		if isinstance(statement, SelectStatement) and len(statement.aggregates) > 0: # aggregated locally over one scan
+			view = MaterializedView(None, statement, self.ad.id)
+			await self.load_view(view)
+			return self.view_table(view)
+
+		if isinstance(statement, SelectStatement):
+			select = ",".join(statement.columns) if len(statement.columns) > 0 else "*"
+			return await self.query(select=select, against=statement.table, where=self.statement_clause(statement.where))
+
+		if isinstance(statement, InsertStatement):
 			kwargs = {}
-			for i in range(len(columns)):
-				kwargs[columns[i].replace(" ", "")] = values[i].replace(" ", "")
-			return await self.insert_into(against=against, **kwargs)
-
-		if sql.startswith("update"):
-			sql = sql.replace("update ", "")
-			against = sql.split(" set ", 1)[0]
-			sql = sql.replace(against + " set ", "", 1)
-			sql = sql.replace(";", "")
-			sets = sql.split(" where ")[0]
-			where = sql.split(" where ")[1]
-			cvs = sets.split(",")
+			for i in range(len(statement.columns)):
+				kwargs[statement.columns[i]] = self.statement_value(statement.values[i])
+			return await self.insert_into(against=statement.table, **kwargs)
+
+		if isinstance(statement, UpdateStatement):
 			kwargs = {}
-			for cv in cvs:
-				column = cv.split("=", 1)[0]
-				column = column.replace(" ", "")
-				value = cv.split("=", 1)[1]
-				if value.startswith(" "):
-					value = value.replace(" ", "")
-				kwargs[column] = value
-			return await self.update(against=against, where=where, **kwargs)
-
-		if sql.startswith("delete"):
-			sql = sql.replace("delete ", "", 1)
-			if "from " in sql:
-				sql = sql.replace("from ", "", 1)
-			elif "against " in sql:
-				sql = sql.replace("against ", "", 1)
-			against = sql.split(" where", 1)[0]
-			sql = sql.replace(against, "", 1)
-			sql = sql.replace("where ", "", 1)
-			sql = sql[1:]
-			return await self.delete(against=against, where=sql)
+			for column, value in statement.assignments:
+				kwargs[column] = self.statement_value(value)
+			return await self.update(against=statement.table, where=self.statement_clause(statement.where), **kwargs)
+
+		if isinstance(statement, DeleteStatement):
+			return await self.delete(against=statement.table, where=self.statement_clause(statement.where))
 
 		raise NameError("invalid sql")
 
+	async def explain(self, statement):
+		"""Plans a parsed SELECT, INSERT, UPDATE or DELETE without running it, returns a Plan"""
+		if self.ad == None:
+			raise Exception("No active database")
+		where = ""
+		cached = False
+		indexed = True
+		if isinstance(statement, SelectStatement):
+			operation = "select"
+			where = self.statement_clause(statement.where)
+			indexed = len(statement.aggregates) == 0 # aggregates are computed over a scan
+			if self.query_cache is not None and indexed:
+				select = ",".join(statement.columns) if len(statement.columns) > 0 else "*"
+				cached = self.query_cache.get(self.query_cache_key(select, statement.table, where), count=False) is not None
+		elif isinstance(statement, InsertStatement):
+			operation = "insert"
+			indexed = False # the row limit check reads the whole table
+		elif isinstance(statement, (UpdateStatement, DeleteStatement)):
+			operation = "update" if isinstance(statement, UpdateStatement) else "delete"
+			where = self.statement_clause(statement.where)
+		else:
+			raise NameError("Cannot explain; only SELECT, INSERT, UPDATE and DELETE are planned")
+
+		master_table = None
+		for t in self.backend.channels(self.ad):
+			if t.name.lower() == self.ad.name.lower():
+				master_table = t
+		shared = (self.schema_memo is not None and master_table.id in self.schema_memo) or self.schema_cached(master_table)
+		with self.schema_session():
+			table, headers, header_row, shard_map = await self.find_table(statement.table)
+			master_count = len(await self.master_records(master_table))
+
+		clause = self.parse_where(where)[0]
+		if shard_map is None:
+			plan = self.plan_table(operation, table, statement.table, clause, cached, indexed)
+		else:
+			shards = self.prune_shards(self.table_shards(table, shard_map), shard_map, headers, clause)
+			if operation == "insert": # reads and writes the shard of its shard key
+				value = ""
+				if shard_map.key in statement.columns:
+					value = self.statement_value(statement.values[statement.columns.index(shard_map.key)])
+				shards = [shards[shard_map.shard(value, self.header_datatype(headers, shard_map.key))]]
+			plans = [plan_read(operation, statement.table, self.table_stats.get(shard.id), clause, indexed=indexed) for shard in shards]
+			plan = plans[0]
+			plan.requests = sum(p.requests for p in plans)
+			plan.scanned = sum(p.scanned for p in plans)
+			plan.rows = sum(p.rows for p in plans)
+			plan.shards = len(plans)
+		if not cached and not shared:
+			plan.schema_requests = history_requests(master_count)
+		if operation == "insert":
+			plan.rows = 1
+			plan.writes = 1
+		elif operation != "select" and plan.rows is not None:
+			plan.writes = int(round(plan.rows))
+		return plan
+
+	async def run_script(self, script):
+		"""Runs the statements of a Script, returns their results in order
+
+		Statements run as soon as every earlier statement touching the same tables has finished,
+		so statements on disjoint tables run concurrently and statements on the same table keep their order.
+		The master table is read once and shared by every statement in the script.
+		If a statement fails the statements depending on it are skipped and the first error is raised
+		once the rest of the script has finished."""
+		dependencies = script.dependencies()
+		tasks = []
+
+		async def run(i):
+			for j in dependencies[i]:
+				try:
+					await tasks[j]
+				except Exception:
+					raise Exception("Statement " + str(i + 1) + " skipped; statement " + str(j + 1) + " failed")
+			return await self.run_statement(script.statements[i])
+
+		with self.schema_session():
+			for i in range(len(script.statements)):
+				tasks.append(asyncio.ensure_future(run(i)))
+			results = await asyncio.gather(*tasks, return_exceptions=True)
+		for result in results:
+			if isinstance(result, Exception):
+				raise result
+		return results
+
+	@contextmanager
+	def schema_session(self):
+		"""Shares master table reads until the outermost session closes"""
+		if self.schema_sessions == 0:
+			self.schema_memo = {}
+		self.schema_sessions += 1
+		try:
+			yield
+		finally:
+			self.schema_sessions -= 1
+			if self.schema_sessions == 0:
+				self.schema_memo = None
+
+	async def master_records(self, master_table):
+		"""Records of a master table, read once per schema session"""
+		if self.schema_memo is None:
+			return await self.read_master(master_table)
+		if master_table.id not in self.schema_memo:
+			self.schema_memo[master_table.id] = self.share_statement(asyncio.ensure_future(self.read_master(master_table)))
+		return await self.schema_memo[master_table.id]
+
+	async def read_master(self, master_table):
+		"""Records of a master table, from the schema cache when it holds them"""
+		if self.schema_cache is not None:
+			records = self.schema_cache.get(self.schema_key(master_table))
+			if records is not None:
+				return list(records) # callers may change their list
+			version = self.schema_cache.version(master_table.name, master_table.name) # before reading, see QueryCache.put
+		records = await self.backend.history(master_table, limit=1024)
+		if self.schema_cache is not None:
+			self.schema_cache.put(self.schema_key(master_table), list(records), version)
+		return records
+
+	def schema_key(self, master_table):
+		"""Schema cache key of a master table, it is named after its database"""
+		return (master_table.name.lower(), master_table.name.lower())
+
+	def schema_cached(self, master_table):
+		"""Checks if the schema cache holds the records of a master table"""
+		return self.schema_cache is not None and self.schema_key(master_table) in self.schema_cache
+
+	# EVENTS #
+	# Forward the matching discord.Client events so caches and subscriptions stay coherent with changes made outside SDDB.
+	# Forward either on_message_edit/on_message_delete or their raw versions, not both, or subscriptions see changes twice.
+
+	def on_message(self, message):
+		self.message_event("create", message.channel, message.id, message.content)
+
+	def on_message_edit(self, before, after):
+		self.message_event("edit", after.channel, after.id, after.content, before.content)
+
+	def on_message_delete(self, message):
+		self.message_event("delete", message.channel, message.id, before=message.content)
+
+	def on_raw_message_edit(self, payload):
+		"""Edits to messages outside of the client's message cache only arrive as raw events"""
+		before = None
+		if payload.cached_message is not None:
+			before = payload.cached_message.content
+		self.message_event("edit", self.find_channel(payload.channel_id), payload.message_id, payload.data.get("content"), before)
+
+	def on_raw_message_delete(self, payload):
+		"""Deletes of messages outside of the client's message cache only arrive as raw events"""
+		before = None
+		if payload.cached_message is not None:
+			before = payload.cached_message.content
+		self.message_event("delete", self.find_channel(payload.channel_id), payload.message_id, before=before)
+
+	def message_event(self, kind, channel, message_id, content=None, before=None):
+		"""Invalidates cached results and notifies subscriptions for the table a message event happened in
+
+		kind is create, edit or delete, content is the message content after the event and before the content
+		before it, either is None when unknown"""
+		if channel is None or self.backend_of(channel) is None:
+			return False
+		database = getattr(channel, "category", None)
+		if database is None:
+			return False
+		if channel.name.lower() == database.name.lower(): # master table, schema may have changed
+			self.invalidate_cache(database.name)
+			self.schema_event(kind, message_id, content)
+		else:
+			self.invalidate_cache(database.name, shard_table_name(channel.name))
+			self.change_event(kind, channel, message_id, content, before)
+		return True
+
+	def schema_event(self, kind, message_id, content):
+		"""Keeps subscriptions current with their table's record in the master table"""
+		for subscription in list(self.subscriptions):
+			if subscription.header_id != message_id:
+				continue
+			if kind == "delete": # table dropped
+				subscription.close()
+			elif kind == "edit" and content is not None:
+				subscription.table_name = content.split(chr(0x2502))[0]
+				subscription.headers = self.build_table_headers(content)
+		for view in self.views.values():
+			if view.header_id == message_id:
+				view.stale = True
+
+	def change_event(self, kind, channel, message_id, content, before):
+		"""Decodes a message event in a table channel into ChangeEvents for its subscriptions"""
+		if kind != "edit" or content is not None:
+			self.view_change(channel.id, message_id, content)
+		if kind != "edit":
+			self.table_stats_change(channel.id, message_id, kind == "create")
+		for subscription in list(self.subscriptions):
+			if subscription.table_id != channel.id and channel.id not in subscription.shard_ids:
+				continue
+			try:
+				self.deliver(subscription, kind, message_id, content, before)
+			except Exception as e: # a subscriber must never fail the write that caused the event
+				logging.getLogger("SDDB").warning("Skipped change event of row " + str(message_id) + " for subscription to " + subscription.table_name + ": " + str(e))
+
+	def deliver(self, subscription, kind, message_id, content, before):
+		"""Pushes the ChangeEvent of a message event to a subscription if it matches its where clause"""
+		row = self.decode_row(subscription.headers, message_id, content)
+		before_row = self.decode_row(subscription.headers, message_id, before)
+		if kind == "create":
+			if row is not None and self.match_clauses(subscription.clauses, row):
+				subscription.push(ChangeEvent(CHANGETYPE.INSERT, subscription.table_name, message_id, row))
+		elif kind == "edit":
+			if row is None:
+				return # not a row, or an edit that did not carry content
+			if self.match_clauses(subscription.clauses, row) or (before_row is not None and self.match_clauses(subscription.clauses, before_row)):
+				subscription.push(ChangeEvent(CHANGETYPE.UPDATE, subscription.table_name, message_id, row, before_row))
+		elif kind == "delete":
+			if before_row is None or self.match_clauses(subscription.clauses, before_row): # unknown rows can't be filtered
+				subscription.push(ChangeEvent(CHANGETYPE.DELETE, subscription.table_name, message_id, None, before_row))
+
+	# INSTRUMENTATION #
+
+	def request_event(self, route, size, wait):
+		"""Adds an API request reported by the backend to the statement running in the current task"""
+		stats = self.current_statement()
+		if stats is not None:
+			stats.request(route, size, wait)
+
+	def current_statement(self):
+		"""StatementStats of the statement running in the current task, None if it is not instrumented"""
+		if len(self.operations) == 0:
+			return None
+		return self.operations.get(current_task())
+
+	def share_statement(self, task):
+		"""Attributes the requests of a task started for the running statement to that statement"""
+		stats = self.current_statement()
+		if stats is not None:
+			self.operations[task] = stats
+			task.add_done_callback(lambda t: self.operations.pop(t, None))
+		return task
+
+	async def analyze_statement(self, statement):
+		"""Runs a statement recorded on its own, returns its result and StatementStats"""
+		stats = StatementStats("sql", statement.sql)
+
+		async def run():
+			task = current_task()
+			self.operations[task] = stats
+			start = time.perf_counter()
+			try:
+				return await self.run_statement(statement)
+			except Exception as e:
+				stats.error = str(e)
+				raise
+			finally:
+				stats.duration = time.perf_counter() - start
+				del self.operations[task]
+
+		return await asyncio.ensure_future(run()), stats
+
+	def record_rows(self, scanned=0, returned=0, decode_time=0.0):
+		stats = self.current_statement()
+		if stats is not None:
+			stats.rows_scanned += scanned
+			stats.rows_returned += returned
+			stats.decode_time += decode_time
+
+	# PLANNING #
+
+	def plan_table(self, operation, table, table_name, clause, cached=False, indexed=True):
+		"""Cheapest Plan to read the rows of table matching clause, see Planner"""
+		view = None
+		if operation == "select" and indexed:
+			view = self.mirror_view(table, clause)
+		return plan_read(operation, table_name, self.table_stats.get(table.id), clause, cached, view, indexed)
+
+	async def read_rows(self, table, plan):
+		"""Messages of the rows a plan reads, with pending journaled writes"""
+		if plan.access == ACCESS.PRIMARY_KEY:
+			snapshot = self.journal_snapshot(table)
+			message = await self.backend_of(table).fetch_message(table, plan.key)
+			return self.merge_pending(table, [message] if message is not None else [], snapshot, key=plan.key)
+		if plan.access == ACCESS.RANGE_SCAN:
+			snapshot = self.journal_snapshot(table)
+			raw_rows = await self.backend_of(table).history(table, limit=1024, before=plan.before, after=plan.after)
+			return self.merge_pending(table, raw_rows, snapshot, before=plan.before, after=plan.after)
+		return await self.scan_table(table)
+
+	async def scan_table(self, table):
+		"""Messages of the newest 1024 rows of table with pending journaled writes, refreshes the table's stats"""
+		snapshot = self.journal_snapshot(table)
+		raw_rows = self.merge_pending(table, await self.backend_of(table).history(table, limit=1024), snapshot)
+		self.table_stats[table.id] = TableStats([m.id for m in raw_rows], len(raw_rows) < 1024)
+		return raw_rows
+
+	def table_stats_change(self, table_id, message_id, exists):
+		"""Adds or removes a row's primary key from the stats of its table"""
+		stats = self.table_stats.get(table_id)
+		if stats is None:
+			return
+		if exists:
+			stats.add(message_id)
+		else:
+			stats.remove(message_id)
+
+	def mirror_view(self, table, clause):
+		"""A fresh, non aggregate MaterializedView over table with the same where clause, None if there is none"""
+		for view in self.views.values():
+			if view.table_id != table.id or view.stale or view.is_aggregate or len(view.shard_ids) > 0:
+				continue
+			view_clause = self.parse_where(self.statement_clause(view.statement.where))[0]
+			if view_clause.field is None and clause.field is None:
+				return view
+			if view_clause.field is None or clause.field is None:
+				continue
+			if view_clause.field.lower() == clause.field.lower() and view_clause.optype == clause.optype and str(view_clause.value) == str(clause.value):
+				return view
+		return None
+
+	# SHARDING #
+
+	def find_shard_map(self, mt_records, against):
+		"""ShardMap of a table from the records of its master table, None if the table is not sharded"""
+		for record in mt_records:
+			shard_map = ShardMap.parse(record.content)
+			if shard_map is not None and shard_map.table_name.lower() == against.lower():
+				shard_map.message = record
+				return shard_map
+		return None
+
+	def table_shards(self, table, shard_map, database=None):
+		"""Channels of every shard of a table in shard order, just the table for unsharded tables"""
+		if shard_map is None:
+			return [table]
+		shards = [table]
+		for i in range(1, shard_map.count):
+			backend = self.shard_backend(shard_map, i)
+			category = self.shard_category(backend, database)
+			shard = None
+			if category is not None:
+				for t in backend.channels(category):
+					if t.name.lower() == shard_map.channel_name(i).lower():
+						shard = t
+			if shard is None:
+				raise NameError("Missing shard " + str(i) + " of table " + shard_map.table_name)
+			shards.append(shard)
+		return shards
+
+	def prune_shards(self, shards, shard_map, headers, clause):
+		"""The shards that can hold rows matching clause, only one if it tests the shard key for equality"""
+		if shard_map is None or clause.field is None or clause.optype != OPTYPE.EQ or clause.field.lower() != shard_map.key.lower():
+			return shards
+		return [shards[shard_map.shard(clause.value, self.header_datatype(headers, shard_map.key))]]
+
+	async def read_shards(self, shards, operation, table_name, clause):
+		"""Messages of the rows of shards matching clause, shards are read concurrently and merged newest first"""
+		reads = []
+		for shard in shards:
+			reads.append(self.read_rows(shard, plan_read(operation, table_name, self.table_stats.get(shard.id), clause)))
+		if len(reads) == 1:
+			return await reads[0]
+		raw_rows = []
+		for rows in await self.fan_out(reads):
+			raw_rows.extend(rows)
+		raw_rows.sort(key=lambda message: message.id, reverse=True)
+		return raw_rows
+
+	async def fan_out(self, coroutines, limit=None):
+		"""Runs coroutines concurrently for the running statement, at most limit at once, returns their results in order"""
+		if limit is not None:
+			semaphore = asyncio.Semaphore(limit)
+			async def bounded(coroutine):
+				async with semaphore:
+					return await coroutine
+			coroutines = [bounded(c) for c in coroutines]
+		tasks = [self.share_statement(asyncio.ensure_future(c)) for c in coroutines]
+		try:
+			return await asyncio.gather(*tasks)
+		except BaseException:
+			for task in tasks: # the statement failed, don't leave the rest running
+				task.cancel()
+			raise
+
+	async def write_rows(self, write, items):
+		"""Awaits write(item) for every item, one write per client of a pool at once, in order with a single client"""
+		limit = max(backend.concurrency() for backend in self.backends)
+		if limit == 1:
+			for item in items:
+				await write(item)
+			return
+		await self.fan_out([write(item) for item in items], limit)
+
+	def shard_backend(self, shard_map, index):
+		guild_id = shard_map.guild_id(index)
+		for backend in self.backends:
+			if backend.guild_id == guild_id:
+				return backend
+		raise NameError("Guild " + str(guild_id) + " of shard " + str(index) + " of table " + shard_map.table_name + " is not configured")
+
+	def shard_category(self, backend, database=None):
+		"""Category of database, the active database by default, on a backend, None if there is none"""
+		if database is None:
+			database = self.ad
+		if backend is self.backend:
+			return database
+		for category in backend.categories():
+			if category.name.lower() == database.name.lower():
+				return category
+		return None
+
+	def backend_of(self, channel):
+		"""Backend a channel belongs to, None if it is not on any of them"""
+		for backend in self.backends:
+			if backend.owns(channel):
+				return backend
+		return None
+
+	def header_datatype(self, headers, column):
+		for header in headers:
+			if header.column_name.lower() == column.lower():
+				return header.datatype
+		return "str"
+
+	# JOURNAL #
+
+	async def send_row(self, table, content):
+		"""Sends a row message, or journals it and returns a PendingMessage with a provisional id"""
+		if self.journal is None:
+			return await self.backend_of(table).send(table, content)
+		entry = self.journal.append("send", table.id, content=content)
+		self.schedule_flush()
+		return PendingMessage(entry.message_id, table, content)
+
+	async def edit_row(self, message, content):
+		if self.journal is None:
+			return await self.backend_of(message.channel).edit_message(message, content)
+		self.journal.append("edit", message.channel.id, message.id, content)
+		self.schedule_flush()
+
+	async def delete_row(self, message):
+		if self.journal is None:
+			return await self.backend_of(message.channel).delete_message(message)
+		self.journal.append("delete", message.channel.id, message.id)
+		self.schedule_flush()
+
+	def journal_snapshot(self, table):
+		if self.journal is None:
+			return None
+		return self.journal.snapshot(table.id)
+
+	def merge_pending(self, table, messages, snapshot, key=None, before=None, after=None):
+		"""Messages read from table with the journaled writes of snapshot applied"""
+		if snapshot is None:
+			return messages
+		return self.journal.overlay(table, messages, snapshot, key, before, after)
+
+	def schedule_flush(self):
+		if self.journal_task is None or self.journal_task.done():
+			self.journal_task = asyncio.ensure_future(self.flush_journal())
+
+	async def flush(self):
+		"""Waits until every journaled write reached the backend, including writes an earlier run left"""
+		if self.journal is None:
+			return True
+		while len(self.journal) > 0:
+			self.schedule_flush()
+			await self.journal_task
+		return True
+
+	async def flush_journal(self):
+		"""Writes the journal to the backend in coalesced batches until it is empty"""
+		journal = self.journal
+		sent = {} # channel id -> messages sent since the first recovered send, to not send those twice
+		while len(journal) > 0:
+			await asyncio.sleep(journal.delay) # writes arriving meanwhile join the batch
+			for write in journal.batch():
+				channel = self.find_channel(write.channel_id)
+				if channel is None: # table dropped
+					journal.drop(write)
+					continue
+				if write.op in ("edit", "delete") and journal.provisional(write.message_id): # resolve failed, the send never reached Discord
+					logging.getLogger("SDDB").warning("Dropped journaled " + write.op + " of row " + str(write.message_id) + " in channel " + str(write.channel_id) + ": its insert was dropped")
+					journal.drop(write)
+					continue
+				backend = self.backend_of(channel)
+				try:
+					id = await self.flush_write(backend, channel, write, sent)
+				except Exception as e:
+					if backend.failed(e) or backend.refused(e):
+						await asyncio.sleep(JOURNAL_RETRY) # the rest of the batch waits, writes stay in order
+						break
+					logging.getLogger("SDDB").warning("Dropped journaled " + str(write.op) + " in channel " + str(write.channel_id) + ": " + str(e))
+					journal.drop(write)
+					continue
+				journal.done(write, id)
+		journal.compact()
+
+	async def flush_write(self, backend, channel, write, sent):
+		"""Makes the request of a JournalWrite, returns the message id of a send"""
+		id = write.message_id
+		if write.op == "send":
+			message = None
+			if write.recovered: # may have been sent before the crash
+				if channel.id not in sent:
+					sent[channel.id] = await backend.history(channel, limit=1024, after=self.journal.since(write.message_id))
+				for m in sent[channel.id]:
+					if m.content == write.content:
+						message = m
+						sent[channel.id].remove(m)
+						break
+			if message is None:
+				message = await backend.send(channel, write.content)
+			self.table_stats_change(channel.id, write.message_id, False)
+			self.view_change(channel.id, write.message_id, None)
+			id = message.id
+			self.table_stats_change(channel.id, id, True)
+		elif write.op == "edit":
+			await backend.edit_message(backend.partial_message(channel, id), write.content)
+		elif write.op == "delete":
+			await backend.delete_message(backend.partial_message(channel, id))
+			self.table_stats_change(channel.id, id, False)
+		if write.op is not None:
+			self.view_change(channel.id, id, write.content)
+			if channel.category is not None:
+				self.invalidate_cache(channel.category.name, shard_table_name(channel.name))
+		return id
+
+	def find_channel(self, id):
+		for backend in self.backends:
+			channel = backend.get_channel(id)
+			if channel is not None:
+				return channel
+		return None
+
 	# UTILS #
 
+	async def find_table(self, against, database=None):
+		"""Returns (table, headers, header_row, shard_map) for a table on database, the active database by default"""
+		if database is None:
+			database = self.ad
+		table = None
+		headers = None
+		header_row = None
+		shard_map = None
+		for t in self.backend.channels(database):
+			if t.name.lower() == database.name.lower():
+				mt_records = await self.master_records(t)
+				shard_map = self.find_shard_map(mt_records, against)
+				for record in mt_records:
+					if against.lower() == record.content.split(chr(0x2502))[0].lower():
+						headers = self.build_table_headers(record)
+						header_row = record
+						break
+			if t.name.lower() == against.lower():
+				table = t
+		if table == None or header_row == None:
+			raise NameError("No table with name: " + against)
+		return table, headers, header_row, shard_map
+
+	async def load_view(self, view):
+		"""Fills a MaterializedView with one scan of its base table"""
+		database = self.backend.get_channel(view.database_id)
+		if database is None:
+			raise NameError("No database for view: " + str(view.name))
+		table, headers, header_row, shard_map = await self.find_table(view.table_name, database)
+		clauses = self.parse_where(self.statement_clause(view.statement.where))
+		shards = self.table_shards(table, shard_map, database)
+		raw_rows = []
+		for rows in await self.fan_out([self.scan_table(shard) for shard in shards]):
+			raw_rows.extend(rows)
+		rows = []
+		start = time.perf_counter()
+		full_table = Table(view.table_name, headers, raw_rows)
+		self.record_rows(scanned=len(raw_rows), decode_time=time.perf_counter() - start)
+		for i in range(len(raw_rows)):
+			if self.match_clauses(clauses, full_table.rows[i]):
+				rows.append((raw_rows[i].id, full_table.rows[i]))
+		view.table_id = table.id
+		view.shard_ids = set(shard.id for shard in shards) if shard_map is not None else set()
+		view.header_id = header_row.id
+		view.load(headers, clauses, rows)
+
+	def view_table(self, view):
+		"""Table of the current contents of a MaterializedView"""
+		header_strs, values = view.read()
+		headers = [TableHeader(h) for h in header_strs]
+		rows = []
+		for row in values:
+			records = []
+			for i in range(len(headers)):
+				records.append(TableRecord(headers[i], "" if row[i] is None else row[i]))
+			rows.append(TableRow(headers, table_records=records))
+		self.record_rows(returned=len(rows))
+		return Table(view.name if view.name is not None else view.table_name, headers, table_rows=rows)
+
+	def view_change(self, table_id, message_id, content):
+		"""Applies a change to a table row to the views over that table, content is None for deletes"""
+		for view in self.views.values():
+			if (view.table_id != table_id and table_id not in view.shard_ids) or view.stale:
+				continue
+			try:
+				row = self.decode_row(view.headers, message_id, content)
+				if row is not None and not self.match_clauses(view.clauses, row):
+					row = None
+				view.apply(message_id, row)
+			except Exception as e: # a view must never fail the write that changed its table, reload it instead
+				view.stale = True
+				logging.getLogger("SDDB").warning("Marked view " + str(view.name) + " stale, applying row " + str(message_id) + " failed: " + str(e))
+
+	def stale_views(self, table_id):
+		"""Marks the views over a table for a reload after its schema changed"""
+		for view in self.views.values():
+			if view.table_id == table_id:
+				view.stale = True
+
+	def check_clauses(self, headers, clauses):
+		"""Raises if a where clause can't be evaluated against rows of headers"""
+		for clause in clauses:
+			if clause.field is None or isinstance(clause.value, Param):
+				continue
+			header = None
+			for h in headers:
+				if h.column_name.lower() == clause.field.lower():
+					header = h
+			if header is None:
+				raise NameError("Malformed where clause; no column with name " + clause.field)
+			if header.datatype == "str" and clause.optype in (OPTYPE.LESS, OPTYPE.GREATER, OPTYPE.LESSEQ, OPTYPE.GREATEREQ):
+				raise TypeError("Malformed where clause; cannot preform numerical comparison operation on string")
+			try:
+				if header.datatype == "int":
+					int(clause.value)
+				elif header.datatype == "float":
+					float(clause.value)
+			except (TypeError, ValueError):
+				raise TypeError("Malformed where clause; " + str(clause.value) + " is not a " + header.datatype)
+
+	def match_clauses(self, clauses, row):
+		"""Checks if a row matches every clause"""
+		for clause in clauses:
+			if not self.match_where(clause, row):
+				return False
+		return True
+
+	def decode_row(self, headers, message_id, content):
+		"""TableRow from message content, None if content is None or not a row of headers"""
+		if content is None:
+			return None
+		try:
+			return TableRow(headers, SimpleNamespace(id=message_id, content=content))
+		except Exception:
+			return None
+
+	def invalidate_cache(self, database, table=None):
+		"""Drops cached query results for table, or every table and the schema of database if table is None"""
+		if self.schema_cache is not None:
+			self.schema_cache.invalidate(database, table)
+		if self.query_cache is None:
+			return 0
+		return self.query_cache.invalidate(database, table)
+
+	def invalidate_schema(self, database):
+		"""Drops the cached master table records of database"""
+		if self.schema_cache is not None:
+			self.schema_cache.invalidate(database, database)
+
+	def query_cache_key(self, select, against, where, database=None):
+		"""Normalized cache key for a query against database, the active database by default"""
+		if database is None:
+			database = self.ad
+		columns = "*"
+		if select.strip() != "*":
+			columns = ",".join(sorted(s.strip().lower() for s in select.split(",")))
+		clauses = []
+		for clause in self.parse_where(where):
+			field = clause.field
+			if field is not None:
+				field = field.lower()
+			clauses.append((field, clause.optype, clause.value))
+		return (database.name.lower(), against.lower(), columns, tuple(clauses))
+
 	def match_where(self, clause, row):
 		"""Checks if a row matches a where clause"""
 		if not isinstance(clause, Clause):
@@ -698,6 +1729,8 @@ class DBMS:
 				if row.headers[i].datatype == "str":
 					if clause.optype == OPTYPE.LESS or clause.optype == OPTYPE.GREATER or clause.optype == OPTYPE.LESSEQ or clause.optype == OPTYPE.GREATEREQ:
 						raise TypeError("Malformed where clause; cannot preform numerical comparison operation on string")
+				if row.headers[i].datatype in ("int", "float", "date") and row.records[i].data == "":
+					return False # NULL never matches a comparison
 				if row.headers[i].datatype == "int":
 					clause.value = int(clause.value)
 					row.records[i].data = int(row.records[i].data)
@@ -729,12 +1762,14 @@ class DBMS:
 						return True
 					return False
 				if clause.optype == OPTYPE.GREATEREQ:
-					if row.records[i].data >= rclause.value:
+					if row.records[i].data >= clause.value:
 						return True
 					return False
 
 	def parse_where(self, clause):
 		"""Returns a list of Clause"""
+		if isinstance(clause, Clause): # already parsed by the sql parser
+			return [clause]
 		if not isinstance(clause, str):
 			raise TypeError("where clause must be a str")
 
@@ -780,6 +1815,24 @@ class DBMS:
 		raise Exception("Unable to parse query; malformed where clause")
 		pass # TODO: support and/or operations for multiple clauses
 
+	def clause_text(self, clause):
+		"""Text of a where clause given as a str or Clause, for rule checks"""
+		if isinstance(clause, Clause):
+			return str(clause.field) + " " + str(clause.value)
+		return clause
+
+	def statement_clause(self, condition):
+		"""Converts a parsed Condition into a Clause, an empty where if condition is None"""
+		if condition is None:
+			return ""
+		return Clause(condition.field, SQL_OPTYPES[condition.operator], self.statement_value(condition.value))
+
+	def statement_value(self, value):
+		"""Parsed or bound values are stored as strings, NULL as an empty string"""
+		if value is None:
+			return ""
+		return str(value)
+
 	def violates_str_rules(self, *args):
 		for checkstr in args:
 			if not isinstance(checkstr, str):
@@ -811,6 +1864,8 @@ class DBMS:
 		return True
 
 	def build_table_headers(self, stream):
+		if isinstance(stream, str): # content of a master table record
+			stream = SimpleNamespace(content=stream)
 		arr = stream.content.split(chr(0x2502))
 		headers = []
 		headers.append(TableHeader("id int", True)) # Message ID = Primary key
@@ -823,7 +1878,7 @@ class DBMS:
 	def change_ad_pointer(self, use):
 		adstore = None
 		if use != "": # change ad pointer for this operation
-			for d in self.db.categories:
+			for d in self.backend.categories():
 				if d.name.lower() == use.lower():
 					adstore = self.ad.name
 					self.ad = d
@@ -847,6 +1902,15 @@ class OPTYPE(Enum):
 	LESSEQ = 4
 	GREATEREQ = 5
 
+SQL_OPTYPES = {
+	"=": OPTYPE.EQ,
+	"!=": OPTYPE.NOT,
+	"<": OPTYPE.LESS,
+	">": OPTYPE.GREATER,
+	"<=": OPTYPE.LESSEQ,
+	">=": OPTYPE.GREATEREQ,
+}
+
 class Clause:
 	"""Wrapper for where clause"""
 	def __init__(self, field, optype, value):
@@ -872,6 +1936,7 @@ class Table:
 		self.table_name = table_name
 		self.headers = headers
 		self.rows = []
+		self.analyze = None # StatementStats of the statement that returned the table when instrumented
 		if rows is not None:
 			for row in rows:
 				self.rows.append(TableRow(headers, row))
@@ -883,18 +1948,35 @@ class Table:
 		return len(self.headers)
 
 	def __str__(self):
-		rs = "table_name: " + self.table_name + "\n"
-		for header in self.headers:
-			rs += header.column_name + " " + header.datatype + chr(0x2502)
-		for row in self.rows:
-			rs += "\n" + str(row)
-		return rs
+		lines = ["table_name: " + self.table_name]
+		lines.append("".join(header.column_name + " " + header.datatype + chr(0x2502) for header in self.headers))
+		lines.extend(str(row) for row in self.rows)
+		return "\n".join(lines)
 
 	def append(self, row):
 		if not isinstance(row, TableRow):
 			raise TypeError("row must be a TableRow object")
 		self.rows.append(row)
 
+	def to_csv(self, fh=None):
+		"""Writes the table as CSV to file object fh, returns the CSV as a str if fh is None"""
+		return write_csv(self.headers, self.rows, fh)
+
+	def to_jsonl(self, fh=None):
+		"""Writes the table as JSON Lines to file object fh, returns them as a str if fh is None"""
+		return write_jsonl(self.headers, self.rows, fh)
+
+	def to_columns(self):
+		"""Dict of a list of values by column name"""
+		return columns(self.headers, self.rows)
+
+	def copy(self):
+		"""Copy of the table whose rows can be changed without affecting the original"""
+		rows = []
+		for row in self.rows:
+			rows.append(TableRow(self.headers, table_records=[copy.copy(r) for r in row.records]))
+		return Table(self.table_name, self.headers, table_rows=rows)
+
 class TableRow:
 	def __init__(self, headers, records=None, table_records=None):
 		self.headers = headers
@@ -922,10 +2004,7 @@ class TableRow:
 		return len(self.records)
 
 	def __str__(self):
-		rs = ""
-		for record in self.records:
-			rs += str(record.data) + chr(0x2502)
-		return rs
+		return "".join(str(record.data) + chr(0x2502) for record in self.records)
 
 	def append_record(self, data):
 		if len(self.records) == len(self.headers):
@@ -941,12 +2020,7 @@ class TableRow:
 
 	def writable(self):
 		"""String of TableRow excluding id for writing to the database"""
-		rs = ""
-		for i in range(len(self.records)):
-			if i == 0:
-				continue
-			rs += str(self.records[i].data) + chr(0x2502)
-		return rs
+		return "".join(str(record.data) + chr(0x2502) for record in self.records[1:])
 
 class TableRecord:
 	def __init__(self, datatype, data):
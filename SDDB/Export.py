@@ -0,0 +1,103 @@
+import io
+import csv
+import json
+from collections import OrderedDict, deque
+
+# Exporters for query results, as CSV, JSON Lines or a dict of column arrays.
+# - Rows are written to a file object one at a time, nothing holds the whole rendered output unless no file object
+#   is given, then the output is returned as a str.
+# - Values are converted by the datatype of their column, empty values are null, so the output doesn't depend on
+#   which values a where clause converted while filtering.  Values that don't convert, like text edited into an int
+#   column outside SDDB, are written as the raw string rather than failing the export.
+# - rows can be any iterable of TableRow, a Table's rows or a QueryIterator, which releases each row once it is
+#   written so an export needs no more memory than the query result.
+
+def values(headers, row):
+	"""Values of a row converted by the datatypes of headers, None for empty values, str for values that don't convert"""
+	converted = []
+	for i in range(len(headers)):
+		data = row.records[i].data
+		datatype = headers[i].datatype.lower()
+		if data is None or data == "":
+			converted.append(None)
+		elif datatype in ("int", "float"):
+			try:
+				converted.append(int(data) if datatype == "int" else float(data))
+			except (TypeError, ValueError):
+				converted.append(str(data))
+		elif datatype == "date" and hasattr(data, "isoformat"):
+			converted.append(data.isoformat())
+		else:
+			converted.append(str(data))
+	return converted
+
+def write_csv(headers, rows, fh=None):
+	"""Writes rows as CSV with a line of column names to fh, returns the CSV as a str if fh is None"""
+	out = io.StringIO() if fh is None else fh
+	writer = csv.writer(out, lineterminator="\n")
+	writer.writerow([header.column_name for header in headers])
+	for row in rows:
+		writer.writerow(["" if value is None else value for value in values(headers, row)])
+	if fh is None:
+		return out.getvalue()
+
+def write_jsonl(headers, rows, fh=None):
+	"""Writes rows as JSON Lines, one object by column name per row, to fh, returns them as a str if fh is None"""
+	out = io.StringIO() if fh is None else fh
+	names = [header.column_name for header in headers]
+	for row in rows:
+		out.write(json.dumps(OrderedDict(zip(names, values(headers, row)))) + "\n")
+	if fh is None:
+		return out.getvalue()
+
+def columns(headers, rows):
+	"""Dict of a list of values by column name, in column order"""
+	arrays = [[] for header in headers]
+	for row in rows:
+		for i, value in enumerate(values(headers, row)):
+			arrays[i].append(value)
+	return OrderedDict(zip([header.column_name for header in headers], arrays))
+
+class QueryIterator:
+	"""Async iterator of the TableRows of a query, created by DBMS.query_iter
+
+	The query runs on the first row or export, rows are released as they are consumed."""
+	def __init__(self, query, table_name):
+		self.query = query # function starting the query, called once
+		self.table_name = table_name
+		self.headers = None # set once the query ran
+		self.rows = None # deque of the rows not consumed yet
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		await self.start()
+		if len(self.rows) == 0:
+			raise StopAsyncIteration
+		return self.rows.popleft()
+
+	async def start(self):
+		if self.rows is None:
+			table = await self.query()
+			self.headers = table.headers
+			self.rows = deque(table.rows)
+
+	def consume(self):
+		while len(self.rows) > 0:
+			yield self.rows.popleft()
+
+	async def to_csv(self, fh=None):
+		"""Writes the rows not consumed yet as CSV, see write_csv"""
+		await self.start()
+		return write_csv(self.headers, self.consume(), fh)
+
+	async def to_jsonl(self, fh=None):
+		"""Writes the rows not consumed yet as JSON Lines, see write_jsonl"""
+		await self.start()
+		return write_jsonl(self.headers, self.consume(), fh)
+
+	async def to_columns(self):
+		"""The rows not consumed yet as a dict of column arrays, see columns"""
+		await self.start()
+		return columns(self.headers, self.consume())
@@ -0,0 +1,109 @@
+import time
+import asyncio
+import functools
+from collections import OrderedDict
+
+# Per statement instrumentation for DBMS, on when DBMS has an instrument callback or query is called with analyze=True.
+# - Backends report every API request with its route, bytes transferred and rate limit wait, see Backend.report_request.
+# - Requests are attributed to the statement running in the current task, tasks a statement starts for shared
+#   reads (the master table of a schema session) are attributed to it too.
+# - DBMS records rows scanned, rows returned and decode time where it decodes messages into rows.
+
+def current_task():
+	"""The running asyncio task, None outside of one"""
+	try:
+		if hasattr(asyncio, "current_task"):
+			return asyncio.current_task()
+		return asyncio.Task.current_task() # Python < 3.7
+	except RuntimeError: # no running event loop
+		return None
+
+class RouteStats:
+	def __init__(self):
+		self.requests = 0
+		self.bytes = 0
+		self.wait = 0.0 # seconds spent waiting on rate limits
+
+class StatementStats:
+	"""What running one statement cost, passed to the instrument callback and attached to returned Tables as analyze"""
+	def __init__(self, operation, target=""):
+		self.operation = operation # engine method, or sql for statements run through sql and prepared statements
+		self.target = target # table or database name, or the sql of the statement
+		self.routes = OrderedDict() # route -> RouteStats, in order of first request
+		self.rows_scanned = 0
+		self.rows_returned = 0 # rows in the result, or rows changed by a write
+		self.decode_time = 0.0
+		self.duration = 0.0
+		self.error = None
+
+	@property
+	def requests(self):
+		return sum(stats.requests for stats in self.routes.values())
+
+	@property
+	def bytes(self):
+		return sum(stats.bytes for stats in self.routes.values())
+
+	@property
+	def wait(self):
+		return sum(stats.wait for stats in self.routes.values())
+
+	def request(self, route, size=0, wait=0.0):
+		if route not in self.routes:
+			self.routes[route] = RouteStats()
+		stats = self.routes[route]
+		stats.requests += 1
+		stats.bytes += size
+		stats.wait += wait
+
+	def __str__(self):
+		lines = [self.operation + " " + str(self.target) + " (actual time=" + milliseconds(self.duration) + " requests=" + str(self.requests) + " bytes=" + str(self.bytes) + " rate limit wait=" + milliseconds(self.wait) + ")"]
+		for route, stats in self.routes.items():
+			lines.append("  -> " + route + " (requests=" + str(stats.requests) + " bytes=" + str(stats.bytes) + " rate limit wait=" + milliseconds(stats.wait) + ")")
+		lines.append("  rows scanned=" + str(self.rows_scanned) + " returned=" + str(self.rows_returned) + " decode time=" + milliseconds(self.decode_time))
+		if self.error is not None:
+			lines.append("  error: " + self.error)
+		return "\n".join(lines)
+
+def milliseconds(seconds):
+	return "{:.3f}ms".format(seconds * 1000)
+
+def instrumented(operation):
+	"""Decorates an async DBMS method so each outermost call in a task is recorded as one statement"""
+	def decorator(method):
+		@functools.wraps(method)
+		async def wrapper(self, *args, **kwargs):
+			task = current_task()
+			if task is None or task in self.operations or (self.instrument is None and not kwargs.get("analyze", False)):
+				return await method(self, *args, **kwargs)
+			stats = StatementStats(operation, statement_target(args, kwargs))
+			self.operations[task] = stats
+			start = time.perf_counter()
+			try:
+				result = await method(self, *args, **kwargs)
+			except Exception as e:
+				stats.error = str(e)
+				raise
+			finally:
+				stats.duration = time.perf_counter() - start
+				del self.operations[task]
+				if self.instrument is not None:
+					self.instrument(stats)
+			if hasattr(result, "analyze"):
+				result.analyze = stats
+			return result
+		return wrapper
+	return decorator
+
+def statement_target(args, kwargs):
+	for key in ("against", "name"):
+		if key in kwargs:
+			return kwargs[key]
+	if len(args) == 0:
+		return ""
+	if isinstance(args[0], str):
+		return args[0]
+	sql = getattr(args[0], "sql", None) # parsed statement
+	if sql is not None:
+		return sql
+	return type(args[0]).__name__
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+from collections import OrderedDict
+from .Backend import DISCORD_EPOCH
+
+# Opt-in write-ahead journal for DBMS, row writes are acknowledged once they are on local disk.
+# - insert_into, update, delete and the row rewrites of alter_table append one entry per message write (send, edit,
+#   delete) to an append only file of JSON lines, fsynced before the statement returns.
+# - DBMS flushes the entries to the backend in the background in batches, writes to the same message within a batch
+#   are coalesced (a send followed by edits is one send, a send followed by a delete is nothing).  Each flushed write
+#   appends a done marker, the file is truncated once every entry is flushed.
+# - Entries without a done marker when the journal is opened are replayed.  A send that reached Discord before its
+#   marker did is recognized by its content in the channel and not sent twice.
+# - Sends get a provisional snowflake until they are flushed, reads merge pending entries into the messages they read
+#   so results include every acknowledged write.  Once flushed the row has the id Discord gave it.
+# - Statements may still hold a provisional id from a read made before the send was flushed, the id Discord gave each
+#   send is remembered for retain seconds, also across truncations and restarts, so their writes reach the row.  Writes
+#   to the provisional id of a send that was dropped or cancelled by a delete are refused when they are journaled,
+#   never acknowledged and lost.  Provisional ids are told apart by the journal's records of its sends, not by their
+#   bits, once forgotten after retain seconds writes to one fail at the backend and are dropped when flushed.
+
+PROVISIONAL = 0x3FF << 12 # worker and process bits of provisional ids, never set by MemoryBackend, Discord may set them
+
+class JournalEntry:
+	def __init__(self, seq, op, channel_id, message_id=None, content=None, recovered=False):
+		self.seq = seq
+		self.op = op # send, edit or delete
+		self.channel_id = channel_id
+		self.message_id = message_id # provisional for sends
+		self.content = content
+		self.recovered = recovered # journaled by an earlier run
+
+	def record(self):
+		return {"seq": self.seq, "op": self.op, "channel": self.channel_id, "message": self.message_id, "content": self.content}
+
+class JournalWrite:
+	"""One backend request flushing one or more coalesced entries for the same message"""
+	def __init__(self, op, channel_id, message_id, content, seq, recovered):
+		self.op = op # send, edit, delete or None when the entries cancelled out
+		self.channel_id = channel_id
+		self.message_id = message_id
+		self.content = content
+		self.seqs = [seq]
+		self.recovered = recovered
+
+class PendingMessage:
+	"""A message as reads see it with the journal's pending writes applied"""
+	def __init__(self, id, channel, content):
+		self.id = id
+		self.channel = channel
+		self.content = content
+
+class Journal:
+	def __init__(self, path, batch_size=100, delay=0.05, sync=True, retain=3600.0):
+		if not isinstance(batch_size, int) or batch_size < 1:
+			raise ValueError("batch_size must be a positive int")
+		self.path = path
+		self.batch_size = batch_size # entries flushed per batch
+		self.delay = delay # seconds the flush waits for more writes to coalesce
+		self.sync = sync # fsync every append, False only survives process crashes
+		self.retain = retain # seconds the message id of a flushed send is remembered
+		self.entries = OrderedDict() # seq -> JournalEntry not flushed yet
+		self.sends = set() # provisional ids of sends not flushed yet
+		self.ids = {} # provisional id -> message id of sends flushed within retain seconds, None if dropped or cancelled
+		self.seq = 0
+		self.recovered = 0
+		self.flushed = 0
+		self.dropped = 0 # entries the backend rejected, like edits of rows deleted meanwhile
+		self.load()
+		self.file = open(self.path, "a", encoding="utf-8")
+
+	def __len__(self):
+		return len(self.entries)
+
+	def load(self):
+		"""Reads the entries an earlier run did not flush"""
+		if not os.path.exists(self.path):
+			return
+		with open(self.path, "rb") as fh:
+			data = fh.read()
+		end = 0 # offset after the last complete line
+		while True:
+			newline = data.find(b"\n", end)
+			if newline == -1: # a line without its newline is torn too
+				break
+			try:
+				record = json.loads(data[end:newline].decode("utf-8"))
+			except ValueError: # torn write of a crash, nothing after it was acknowledged
+				break
+			end = newline + 1
+			if "done" in record:
+				for seq in record["done"]:
+					entry = self.entries.pop(seq, None)
+					if entry is not None and entry.op == "send":
+						self.sends.discard(entry.message_id)
+				if record.get("provisional") is not None:
+					self.ids[record["provisional"]] = record.get("id")
+			else:
+				self.entries[record["seq"]] = JournalEntry(record["seq"], record["op"], record["channel"], record["message"], record["content"], True)
+				if record["op"] == "send":
+					self.sends.add(record["message"])
+				self.seq = max(self.seq, record["seq"])
+		if end < len(data): # appends would continue the torn line, losing every entry after it on the next load
+			with open(self.path, "r+b") as fh:
+				fh.truncate(end)
+				fh.flush()
+				os.fsync(fh.fileno())
+		self.recovered = len(self.entries)
+
+	def write(self, record):
+		self.file.write(json.dumps(record) + "\n")
+		self.file.flush()
+		if self.sync:
+			os.fsync(self.file.fileno())
+
+	def append(self, op, channel_id, message_id=None, content=None):
+		"""Durably journals a message write, returns its JournalEntry"""
+		if op != "send" and not self.resolvable(message_id):
+			raise NameError("No row with provisional id " + str(message_id) + ", its insert was dropped or deleted before it was flushed")
+		self.seq += 1
+		if op == "send":
+			message_id = self.provisional_id(self.seq)
+			self.sends.add(message_id)
+		entry = JournalEntry(self.seq, op, channel_id, message_id, content)
+		self.write(entry.record())
+		self.entries[entry.seq] = entry
+		return entry
+
+	def provisional_id(self, seq):
+		"""A snowflake for a journaled send, ordered like the one Discord will give it"""
+		return ((int(time.time() * 1000) - DISCORD_EPOCH) << 22) | PROVISIONAL | (seq & 0xFFF)
+
+	def since(self, message_id):
+		"""The largest snowflake before the millisecond of a provisional id, Discord ids from that millisecond on are after it"""
+		return (message_id >> 22 << 22) - 1
+
+	def provisional(self, message_id):
+		"""Checks if message_id is the provisional id of a send that is pending, or was flushed or dropped within retain"""
+		return message_id in self.sends or message_id in self.ids
+
+	def resolvable(self, message_id):
+		"""Checks if writes to message_id can reach a message, False for provisional ids of dropped or cancelled sends"""
+		return message_id in self.sends or self.ids.get(message_id, message_id) is not None
+
+	def resolve(self, message_id):
+		"""Message id of a row, the real one for provisional ids of flushed sends"""
+		id = self.ids.get(message_id)
+		return message_id if id is None else id
+
+	def batch(self):
+		"""JournalWrites for the oldest pending entries, coalesced per message in order of first write"""
+		writes = OrderedDict() # (channel id, message id) -> JournalWrite
+		for entry in list(self.entries.values())[:self.batch_size]:
+			key = (entry.channel_id, self.resolve(entry.message_id))
+			write = writes.get(key)
+			if write is None:
+				writes[key] = JournalWrite(entry.op, entry.channel_id, key[1], entry.content, entry.seq, entry.recovered)
+				continue
+			write.seqs.append(entry.seq)
+			write.recovered = write.recovered or entry.recovered
+			if entry.op == "edit" and write.op in ("send", "edit"):
+				write.content = entry.content
+			elif entry.op == "delete":
+				write.op = None if write.op == "send" else "delete" # never sent, nothing to delete
+				write.content = None
+		return list(writes.values())
+
+	def done(self, write, id=None):
+		"""Marks the entries of a flushed write, id is the message id a send got"""
+		record = {"done": write.seqs}
+		for seq in write.seqs:
+			entry = self.entries[seq]
+			if entry.op == "send": # writes to the row go to id from now on, or are refused without one
+				record["provisional"] = entry.message_id
+				record["id"] = id if write.op == "send" else None
+				self.ids[entry.message_id] = record["id"]
+		self.write(record)
+		for seq in write.seqs:
+			entry = self.entries.pop(seq)
+			if entry.op == "send":
+				self.sends.discard(entry.message_id)
+		self.flushed += len(write.seqs)
+
+	def drop(self, write):
+		"""Gives up on a write the backend rejected"""
+		self.done(write)
+		self.flushed -= len(write.seqs)
+		self.dropped += len(write.seqs)
+
+	def snapshot(self, channel_id):
+		"""Pending entries of a channel, taken before reading it so entries flushed during the read still count"""
+		return ([entry for entry in self.entries.values() if entry.channel_id == channel_id], self.ids)
+
+	def overlay(self, channel, messages, snapshot, key=None, before=None, after=None, limit=1024):
+		"""Messages read from channel with the writes pending when snapshot was taken applied, newest first
+
+		key, before and after are the bounds of the read, sends outside them are not added."""
+		entries, ids = snapshot
+		if len(entries) == 0:
+			return messages
+		sends = OrderedDict() # provisional id -> content
+		edits = {}
+		deleted = set()
+		for entry in entries:
+			id = ids.get(entry.message_id) or entry.message_id # None for dropped sends
+			if entry.op == "send":
+				sends[entry.message_id] = entry.content
+			elif id in sends:
+				if entry.op == "edit":
+					sends[id] = entry.content
+				else:
+					del sends[id]
+			elif entry.op == "edit":
+				edits[id] = entry.content
+			else:
+				edits.pop(id, None)
+				deleted.add(id)
+		read_ids = set(message.id for message in messages)
+		for id in list(sends):
+			if ids.get(id) in read_ids: # flushed while the channel was read
+				edits[ids[id]] = sends.pop(id)
+		merged = []
+		for message in messages:
+			if message.id in deleted:
+				continue
+			if message.id in edits:
+				message = PendingMessage(message.id, message.channel, edits[message.id])
+			merged.append(message)
+		for id, content in sends.items():
+			if (key is not None and id != key) or (before is not None and id >= before) or (after is not None and id <= after):
+				continue
+			merged.append(PendingMessage(id, channel, content))
+		merged.sort(key=lambda message: message.id, reverse=True)
+		if len(merged) > limit:
+			merged = merged[-limit:] if after is not None else merged[:limit]
+		return merged
+
+	def compact(self):
+		"""Truncates the file once every entry is flushed, keeping the message ids of sends flushed within retain"""
+		if len(self.entries) > 0:
+			return False
+		oldest = (int((time.time() - self.retain) * 1000) - DISCORD_EPOCH) << 22
+		for id in [id for id in self.ids if id < oldest]:
+			del self.ids[id]
+		self.file.close()
+		self.file = open(self.path, "w", encoding="utf-8")
+		for provisional, id in self.ids.items():
+			self.file.write(json.dumps({"done": [], "provisional": provisional, "id": id}) + "\n")
+		self.file.flush()
+		if self.sync:
+			os.fsync(self.file.fileno())
+		return True
+
+	def close(self):
+		self.file.close()
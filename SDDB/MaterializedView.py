@@ -0,0 +1,207 @@
+from collections import OrderedDict
+
+# Materialized views keep the result of a SELECT in memory and update it incrementally.
+# - The view holds the rows of its base table matching the where clause, keyed by primary key.
+# - DBMS applies each change to the base table (SDDB writes and forwarded message events) with apply,
+#   applying the same change twice is harmless so writes seen both ways are not double counted.
+# - Aggregate views (COUNT, SUM, AVG, MIN, MAX with an optional GROUP BY) keep running totals per group,
+#   MIN and MAX are only recomputed from the group's rows when the current extreme leaves the group.
+# - A schema change to the base table marks the view stale, it is reloaded with one scan on the next read.
+
+class Group:
+	"""Running aggregates for the rows of one group"""
+	def __init__(self, functions):
+		self.functions = functions
+		self.values = {} # id -> aggregated values of the row
+		self.counts = [0] * len(functions) # non NULL values per aggregate
+		self.sums = [0] * len(functions)
+		self.extremes = [None] * len(functions)
+		self.recompute = [False] * len(functions)
+
+	def __len__(self):
+		return len(self.values)
+
+	def add(self, id, values):
+		self.values[id] = values
+		for i in range(len(self.functions)):
+			value = values[i]
+			if value is None:
+				continue
+			self.counts[i] += 1
+			if self.functions[i] in ("sum", "avg"):
+				self.sums[i] += value
+			elif self.functions[i] in ("min", "max") and not self.recompute[i]:
+				if self.extremes[i] is None or self.better(i, value, self.extremes[i]):
+					self.extremes[i] = value
+
+	def remove(self, id):
+		values = self.values.pop(id)
+		for i in range(len(self.functions)):
+			value = values[i]
+			if value is None:
+				continue
+			self.counts[i] -= 1
+			if self.functions[i] in ("sum", "avg"):
+				self.sums[i] -= value
+			elif self.functions[i] in ("min", "max") and value == self.extremes[i]:
+				self.recompute[i] = True
+
+	def better(self, i, value, other):
+		if self.functions[i] == "min":
+			return value < other
+		return value > other
+
+	def result(self, i):
+		function = self.functions[i]
+		if function == "count":
+			return self.counts[i]
+		if self.counts[i] == 0:
+			return None
+		if function == "sum":
+			return self.sums[i]
+		if function == "avg":
+			return self.sums[i] / self.counts[i]
+		if self.recompute[i]:
+			self.extremes[i] = None
+			for values in self.values.values():
+				if values[i] is not None and (self.extremes[i] is None or self.better(i, values[i], self.extremes[i])):
+					self.extremes[i] = values[i]
+			self.recompute[i] = False
+		return self.extremes[i]
+
+class MaterializedView:
+	def __init__(self, name, statement, database_id=None, table_id=None, header_id=None):
+		self.name = name
+		self.statement = statement # SelectStatement the view materializes
+		self.table_name = statement.table
+		self.database_id = database_id
+		self.table_id = table_id # base table channel
+		self.shard_ids = set() # channels of every shard of a sharded base table
+		self.header_id = header_id # record of the base table in the master table
+		self.headers = None # headers of the base table
+		self.clauses = None
+		self.rows = OrderedDict() # id -> TableRow of matching base table rows
+		self.groups = OrderedDict() # group value -> Group, aggregate views only
+		self.result = None # (headers, rows) of the last read, None after a change
+		self.stale = True
+		self.changes = 0
+		self.loads = 0
+
+	def __len__(self):
+		return len(self.rows)
+
+	@property
+	def is_aggregate(self):
+		return len(self.statement.aggregates) > 0
+
+	def load(self, headers, clauses, rows):
+		"""Replaces the contents of the view, rows is a list of (id, TableRow) matching clauses"""
+		self.headers = headers
+		self.clauses = clauses
+		self.bind_columns()
+		self.rows.clear()
+		self.groups.clear()
+		for id, row in rows:
+			self.add(id, row)
+		self.result = None
+		self.stale = False
+		self.loads += 1
+
+	def bind_columns(self):
+		names = [h.column_name.lower() for h in self.headers]
+
+		def index(column):
+			if column not in names:
+				raise NameError("No column with name " + column)
+			return names.index(column)
+
+		self.columns = [index(c) for c in self.statement.columns]
+		if len(self.columns) == 0 and not self.is_aggregate:
+			self.columns = list(range(len(names)))
+		self.group_index = None
+		if self.statement.group_by is not None:
+			self.group_index = index(self.statement.group_by)
+		self.aggregates = []
+		for function, column in self.statement.aggregates:
+			if column == "*":
+				self.aggregates.append((function, None))
+				continue
+			i = index(column)
+			if function in ("sum", "avg") and self.headers[i].datatype not in ("int", "float"):
+				raise TypeError("Malformed view; cannot " + function + " non numeric column " + column)
+			self.aggregates.append((function, i))
+
+	def apply(self, id, row):
+		"""Applies a change to the base table row with primary key id, row is None if it was deleted or no longer matches"""
+		self.remove(id)
+		if row is not None:
+			self.add(id, row)
+		self.result = None
+		self.changes += 1
+
+	def add(self, id, row):
+		self.rows[id] = row
+		if self.is_aggregate:
+			key = self.value(row, self.group_index)
+			if key not in self.groups:
+				self.groups[key] = Group([function for function, i in self.aggregates])
+			self.groups[key].add(id, [self.value(row, i) for function, i in self.aggregates])
+
+	def remove(self, id):
+		row = self.rows.pop(id, None)
+		if row is None or not self.is_aggregate:
+			return
+		key = self.value(row, self.group_index)
+		self.groups[key].remove(id)
+		if len(self.groups[key]) == 0:
+			del self.groups[key]
+
+	def value(self, row, index):
+		"""Typed value of a record, None for NULL, 1 for COUNT(*)"""
+		if index is None:
+			return 1
+		data = row.records[index].data
+		if data == "":
+			return None
+		datatype = self.headers[index].datatype
+		if datatype == "int":
+			return int(data)
+		if datatype == "float":
+			return float(data)
+		return data
+
+	def read(self):
+		"""Returns (headers, rows) of the view, headers are "name datatype" strings and rows are lists of values"""
+		if self.result is not None:
+			return self.result
+		if self.is_aggregate:
+			headers = []
+			if self.group_index is not None:
+				headers.append(self.headers[self.group_index].column_name + " " + self.headers[self.group_index].datatype)
+			for function, i in self.aggregates:
+				if i is None:
+					headers.append(function + " int")
+				elif function == "count":
+					headers.append(function + "_" + self.headers[i].column_name + " int")
+				elif function == "avg":
+					headers.append(function + "_" + self.headers[i].column_name + " float")
+				else:
+					headers.append(function + "_" + self.headers[i].column_name + " " + self.headers[i].datatype)
+			rows = []
+			groups = self.groups
+			if len(groups) == 0 and self.group_index is None: # aggregates over no rows still have a row
+				groups = {None: Group([function for function, i in self.aggregates])}
+			for key, group in groups.items():
+				values = []
+				if self.group_index is not None:
+					values.append(key)
+				for i in range(len(self.aggregates)):
+					values.append(group.result(i))
+				rows.append(values)
+		else:
+			headers = [self.headers[i].column_name + " " + self.headers[i].datatype for i in self.columns]
+			rows = []
+			for id in sorted(self.rows, reverse=True): # newest first like the table channel history
+				rows.append([self.rows[id].records[i].data for i in self.columns])
+		self.result = (headers, rows)
+		return self.result
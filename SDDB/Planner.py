@@ -0,0 +1,161 @@
+from enum import Enum
+from .Backend import history_requests
+
+# Cost based planning of how a statement reads its table, the cost of a plan is its estimated API requests.
+# - Full scan: the history of the table channel, its newest 1024 rows.
+# - Primary key fetch: WHERE id = x fetches the one message.
+# - Range scan: WHERE id <, <=, > or >= x only pages the history before or after the snowflake x.
+# - Query cache and materialized view: the rows are already held in memory, no requests.
+# Estimates use the primary keys DBMS has seen in the table (TableStats), kept current by full scans, SDDB writes
+# and forwarded message events.  Tables that have not been scanned yet are assumed to be full.
+
+HISTORY_LIMIT = 1024 # rows a scan reads
+
+# estimated share of rows matching a where clause on a column other than id, by OPTYPE name
+SELECTIVITY = {
+	"EQ": 0.1,
+	"NOT": 0.9,
+	"LESS": 1 / 3,
+	"GREATER": 1 / 3,
+	"LESSEQ": 1 / 3,
+	"GREATEREQ": 1 / 3,
+}
+
+class ACCESS(Enum):
+	FULL_SCAN = 0
+	PRIMARY_KEY = 1
+	RANGE_SCAN = 2
+	QUERY_CACHE = 3
+	MATERIALIZED_VIEW = 4
+
+class TableStats:
+	"""Primary keys seen in a table"""
+	def __init__(self, ids=(), complete=True):
+		self.ids = set(ids)
+		self.complete = complete # False if the table held more rows than a scan reads
+
+	def __len__(self):
+		return len(self.ids)
+
+	def add(self, id):
+		self.ids.add(id)
+
+	def remove(self, id):
+		self.ids.discard(id)
+
+	def count(self, before=None, after=None):
+		"""Rows between the exclusive bounds before and after"""
+		return sum(1 for id in self.ids if (before is None or id < before) and (after is None or id > after))
+
+class Plan:
+	"""How a statement reads its table, with estimated rows and API requests"""
+	def __init__(self, operation, table_name, access, requests=0, scanned=None, rows=None, key=None, before=None, after=None, view=None, stats=None):
+		self.operation = operation # select, insert, update or delete
+		self.table_name = table_name
+		self.access = access # ACCESS
+		self.requests = requests # estimated requests to read the table
+		self.scanned = scanned # estimated rows read, None if unknown
+		self.rows = rows # estimated rows matching, None if unknown
+		self.key = key # primary key of a primary key fetch
+		self.before = before # bounds of a range scan
+		self.after = after
+		self.view = view # MaterializedView the rows are read from
+		self.stats = stats # TableStats the estimates are based on, None if the table was never scanned
+		self.shards = 1 # shards read, the estimates are totals over them
+		self.schema_requests = 0 # estimated requests to read the master table
+		self.writes = 0 # estimated requests to write rows
+		self.actual = None # StatementStats of running the statement, EXPLAIN ANALYZE only
+
+	@property
+	def total_requests(self):
+		return self.schema_requests + self.requests + self.writes
+
+	def describe(self):
+		if self.access == ACCESS.PRIMARY_KEY:
+			return "primary key fetch (id = " + str(self.key) + ")"
+		if self.access == ACCESS.RANGE_SCAN:
+			bounds = []
+			if self.after is not None:
+				bounds.append("id > " + str(self.after))
+			if self.before is not None:
+				bounds.append("id < " + str(self.before))
+			return "range scan (" + " and ".join(bounds) + ")"
+		if self.access == ACCESS.QUERY_CACHE:
+			return "query cache"
+		if self.access == ACCESS.MATERIALIZED_VIEW:
+			return "materialized view " + str(self.view.name)
+		return "full scan"
+
+	def __repr__(self):
+		return "Plan(" + self.operation + " " + self.table_name + ": " + self.describe() + ")"
+
+	def __str__(self):
+		lines = [self.operation + " " + self.table_name + ": " + self.describe()]
+		shards = "" if self.shards == 1 else " shards=" + str(self.shards)
+		lines.append("  -> read (estimated requests=" + str(self.requests) + shards + " rows scanned=" + estimate(self.scanned) + " rows=" + estimate(self.rows) + ")")
+		if self.writes > 0:
+			lines.append("  -> write (estimated requests=" + str(self.writes) + ")")
+		lines.append("  -> schema (estimated requests=" + str(self.schema_requests) + ")")
+		if self.stats is None:
+			lines.append("  table stats: none, table not scanned yet")
+		else:
+			lines.append("  table stats: rows=" + str(len(self.stats)) + ("" if self.stats.complete else "+"))
+		lines.append("estimated API requests=" + str(self.total_requests))
+		if self.actual is not None:
+			lines.append(str(self.actual))
+		return "\n".join(lines)
+
+def estimate(value):
+	if value is None:
+		return "?"
+	return str(int(round(value)))
+
+def plan_read(operation, table_name, stats, clause, cached=False, view=None, indexed=True):
+	"""Cheapest Plan to read the rows of a table matching clause
+
+	stats is the table's TableStats or None, cached is True if the query cache holds the result, view is a fresh
+	MaterializedView holding exactly the matching rows and indexed is False for statements that have to scan."""
+	if cached:
+		return Plan(operation, table_name, ACCESS.QUERY_CACHE, stats=stats)
+	if view is not None:
+		return Plan(operation, table_name, ACCESS.MATERIALIZED_VIEW, scanned=0, rows=len(view), view=view, stats=stats)
+
+	total = len(stats) if stats is not None and stats.complete else HISTORY_LIMIT
+	selectivity = 1.0
+	if clause.field is not None:
+		selectivity = SELECTIVITY[clause.optype.name]
+	plans = [Plan(operation, table_name, ACCESS.FULL_SCAN, history_requests(total, HISTORY_LIMIT), total, total * selectivity, stats=stats)]
+
+	key = primary_key(clause) if indexed else None
+	if key is not None:
+		optype = clause.optype.name
+		if optype == "EQ":
+			rows = 1
+			if stats is not None and stats.complete and key not in stats.ids:
+				rows = 0
+			plans.append(Plan(operation, table_name, ACCESS.PRIMARY_KEY, 1, 1, rows, key=key, stats=stats))
+		elif optype != "NOT":
+			before, after = None, None
+			if optype == "LESS":
+				before = key
+			elif optype == "LESSEQ":
+				before = key + 1
+			elif optype == "GREATER":
+				after = key
+			else:
+				after = key - 1
+			if stats is not None and stats.complete:
+				rows = stats.count(before, after)
+			else:
+				rows = total * selectivity
+			plans.append(Plan(operation, table_name, ACCESS.RANGE_SCAN, history_requests(int(rows), HISTORY_LIMIT), rows, rows, before=before, after=after, stats=stats))
+	return min(plans, key=lambda plan: (plan.requests, plan.scanned)) # ties go to the plan reading fewer rows
+
+def primary_key(clause):
+	"""The snowflake a where clause compares id with, None if it does not"""
+	if clause.field is None or clause.field.lower() != "id":
+		return None
+	try:
+		return int(clause.value)
+	except (TypeError, ValueError):
+		return None
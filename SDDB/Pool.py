@@ -0,0 +1,207 @@
+import time
+from collections import deque
+from .Backend import Backend, ROUTES, RATE_LIMITS, GLOBAL_RATE_LIMIT, history_requests
+
+# A pool of clients (bot tokens) connected to the same guild, every token has its own rate limit buckets so
+# spreading requests over the pool multiplies the requests SDDB can make before it has to wait.
+# - Each request goes to the connected client with the most rate limit budget left for its route and channel,
+#   estimated from the requests the client made within the bucket windows of RATE_LIMITS.  Ties go to the client
+#   with the fewest requests in flight, then to the first client.
+# - A client that reports a rate limit wait is avoided for that long, a client whose request failed because of its
+#   connection is avoided for FAILOVER_COOLDOWN and the request is retried on the next client.  Writes that could
+#   have been carried out (send, create) are only retried when the client refused them.
+# - Categories, channels and messages from one client are translated to another's with Backend.local.
+
+FAILOVER_COOLDOWN = 5.0 # seconds a client that failed a request is avoided
+
+class RateBudget:
+	"""Requests a client made in the current window of each rate limit bucket"""
+	def __init__(self, rate_limits=RATE_LIMITS, global_rate_limit=GLOBAL_RATE_LIMIT):
+		self.rate_limits = rate_limits
+		self.global_rate_limit = global_rate_limit
+		self.windows = {} # (route, major) -> request times, None -> request times on any route
+
+	def spend(self, route, major, now, count=1):
+		for key in self.keys(route, major):
+			self.windows.setdefault(key, deque()).extend([now] * count)
+
+	def remaining(self, route, major, now):
+		"""Requests left before the client has to wait, negative if it is already behind"""
+		remaining = None
+		for key in self.keys(route, major):
+			limit, per = self.global_rate_limit if key is None else self.rate_limits[route]
+			window = self.windows.get(key, ())
+			while len(window) > 0 and window[0] <= now - per:
+				window.popleft()
+			if remaining is None or limit - len(window) < remaining:
+				remaining = limit - len(window)
+		return remaining if remaining is not None else 0
+
+	def keys(self, route, major):
+		keys = []
+		if self.global_rate_limit is not None:
+			keys.append(None)
+		if route in self.rate_limits:
+			keys.append((route, major))
+		return keys
+
+class PoolClient:
+	"""A client of a BackendPool with its scheduling state"""
+	def __init__(self, backend, index):
+		self.backend = backend
+		self.index = index
+		self.budget = RateBudget()
+		self.in_flight = 0
+		self.avoid_until = 0.0 # pool clock time until which the client is rate limited or failing
+		self.requests = 0
+		self.failures = 0
+
+class BackendPool(Backend):
+	"""Several clients of the same guild used as one backend, requests are balanced by rate limit budget"""
+	def __init__(self, backends, clock=time.monotonic):
+		Backend.__init__(self)
+		if len(backends) == 0 or not all(isinstance(backend, Backend) for backend in backends):
+			raise TypeError("backends must be a list of Backend")
+		if len(set(backend.guild_id for backend in backends)) != 1:
+			raise ValueError("Every client of a pool must be connected to the same guild")
+		self.guild_id = backends[0].guild_id
+		self.clock = clock # seconds, simulated backends pass their simulated clock
+		self.clients = [PoolClient(backend, i) for i, backend in enumerate(backends)]
+		for client in self.clients:
+			client.backend.add_listener(self.dispatch)
+			client.backend.add_monitor(self.monitor(client))
+
+	@property
+	def d(self):
+		"""Discord client of the first client, None for other backends"""
+		return getattr(self.clients[0].backend, "d", None)
+
+	@property
+	def db(self):
+		return getattr(self.clients[0].backend, "db", None)
+
+	def monitor(self, client):
+		def callback(route, size, wait):
+			if wait > 0: # the client's bucket ran out, let others take its requests while it recovers
+				client.avoid_until = max(client.avoid_until, self.clock() + wait)
+			self.report_request(route, size, wait)
+		return callback
+
+	def choose(self, route, major, tried=()):
+		"""The connected client with the most budget left for a request, None if none is left to try"""
+		now = self.clock()
+		best, best_key = None, None
+		for client in self.clients:
+			if client in tried or not client.backend.available():
+				continue
+			key = (max(client.avoid_until - now, 0.0), -client.budget.remaining(route, major, now), client.in_flight, client.index)
+			if best is None or key < best_key:
+				best, best_key = client, key
+		return best
+
+	async def run(self, operation, major, call, idempotent=False):
+		"""Awaits call(backend) on the best client, failing over to the others
+
+		Requests that are not idempotent are only retried when the failed client refused them."""
+		route = ROUTES[operation]
+		tried = []
+		error = None
+		while True:
+			client = self.choose(route, major, tried)
+			if client is None:
+				if error is not None:
+					raise error
+				raise ConnectionError("No client of the pool is connected")
+			client.budget.spend(route, major, self.clock())
+			client.requests += 1
+			client.in_flight += 1
+			try:
+				return await call(client.backend)
+			except Exception as e:
+				refused = client.backend.refused(e)
+				if not refused and not client.backend.failed(e):
+					raise # the request's fault, another client would fail the same way
+				client.failures += 1
+				client.avoid_until = self.clock() + FAILOVER_COOLDOWN
+				if not refused and not idempotent:
+					raise
+				tried.append(client)
+				error = e
+			finally:
+				client.in_flight -= 1
+
+	def primary(self):
+		"""First connected client, for lookups in the guild's cached state"""
+		for client in self.clients:
+			if client.backend.available():
+				return client.backend
+		return self.clients[0].backend
+
+	def close(self):
+		for client in self.clients:
+			client.backend.close()
+
+	def administrator(self):
+		return all(client.backend.administrator() for client in self.clients)
+
+	def available(self):
+		return any(client.backend.available() for client in self.clients)
+
+	def concurrency(self):
+		return max(1, sum(1 for client in self.clients if client.backend.available()))
+
+	def owns(self, channel):
+		return any(client.backend.owns(channel) for client in self.clients)
+
+	def categories(self):
+		return self.primary().categories()
+
+	def channels(self, category):
+		return self.primary().channels(category)
+
+	def get_channel(self, id):
+		return self.primary().get_channel(id)
+
+	async def create_category(self, name, reason=None):
+		return await self.run("create_category", self.guild_id, lambda backend: backend.create_category(name, reason=reason))
+
+	async def create_text_channel(self, name, category, reason=None):
+		return await self.run("create_text_channel", self.guild_id, lambda backend: backend.create_text_channel(name, backend.local(category) if category is not None else None, reason=reason))
+
+	async def rename_channel(self, channel, name, reason=None):
+		return await self.run("rename_channel", channel.id, lambda backend: backend.rename_channel(backend.local(channel), name, reason=reason), True)
+
+	async def delete_channel(self, channel, reason=None):
+		return await self.run("delete_channel", channel.id, lambda backend: backend.delete_channel(backend.local(channel), reason=reason), True)
+
+	async def history(self, channel, limit=1024, before=None, after=None):
+		async def call(backend):
+			messages = await backend.history(backend.local(channel), limit=limit, before=before, after=after)
+			pages = history_requests(len(messages), limit) - 1 # run spent the first page
+			self.client_of(backend).budget.spend(ROUTES["history"], channel.id, self.clock(), pages)
+			return messages
+		return await self.run("history", channel.id, call, True)
+
+	async def send(self, channel, content):
+		return await self.run("send", channel.id, lambda backend: backend.send(backend.local(channel), content))
+
+	async def edit_message(self, message, content):
+		await self.run("edit_message", message.channel.id, lambda backend: backend.edit_message(backend.local(message), content), True)
+		if hasattr(message, "content"): # the client that edited it may have held its own copy, partial messages have none
+			message.content = content
+		return message
+
+	async def delete_message(self, message):
+		return await self.run("delete_message", message.channel.id, lambda backend: backend.delete_message(backend.local(message)), True)
+
+	async def fetch_message(self, channel, id):
+		return await self.run("fetch_message", channel.id, lambda backend: backend.fetch_message(backend.local(channel), id), True)
+
+	def partial_message(self, channel, id):
+		return self.primary().partial_message(channel, id)
+
+	def client_of(self, backend):
+		for client in self.clients:
+			if client.backend is backend:
+				return client
+		return None
@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+
+# Opt-in result cache for DBMS.query, saves a trip to Discord for repeated statements.
+# - Entries are keyed by the normalized statement, the key always starts with (database, table).
+# - Entries expire after ttl seconds, the least recently used entry is evicted once max_size is reached.
+# - SDDB writes and gateway message events invalidate every entry for the affected table.
+# - Every invalidation bumps a version of the table (or database), a result read while its table was invalidated is
+#   not cached, it may predate the change.  Callers take version() before reading and pass it to put.
+# DBMS also uses a QueryCache without a ttl as the LRU of parsed sql statements, keyed by statement text.
+# A QueryCache passed as schema_cache keeps master table records, keyed by (database, database).
+
+class QueryCache:
+	def __init__(self, max_size=128, ttl=60):
+		if not isinstance(max_size, int) or max_size < 1:
+			raise ValueError("max_size must be a positive int")
+		if ttl is not None and ttl <= 0:
+			raise ValueError("ttl must be a positive number or None")
+		self.max_size = max_size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+		self.entries = OrderedDict() # key -> (expiry, value)
+		self.versions = {} # (database, table) -> invalidations, table is None for whole database invalidations
+		self.generation = 0 # clears
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		return self.get(key, count=False) is not None
+
+	def get(self, key, count=True):
+		"""Returns the cached value for key or None, counts a hit or miss"""
+		entry = self.entries.get(key)
+		if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+			del self.entries[key]
+			entry = None
+		if entry is None:
+			if count:
+				self.misses += 1
+			return None
+		self.entries.move_to_end(key)
+		if count:
+			self.hits += 1
+		return entry[1]
+
+	def version(self, database, table):
+		"""Version of a table, changes whenever the table's entries are invalidated"""
+		database = database.lower()
+		return (self.generation, self.versions.get((database, None), 0), self.versions.get((database, table.lower()), 0))
+
+	def put(self, key, value, version=None):
+		"""Stores value under key, evicting the least recently used entry if full
+
+		With the version of key's table taken before value was read, value is only stored if the table was not
+		invalidated since.  Returns True if value was stored."""
+		if version is not None and version != self.version(key[0], key[1]):
+			return False
+		expiry = None
+		if self.ttl is not None:
+			expiry = time.monotonic() + self.ttl
+		if key in self.entries:
+			del self.entries[key]
+		self.entries[key] = (expiry, value)
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+		return True
+
+	def invalidate(self, database, table=None):
+		"""Drops every entry for table on database, or for the whole database if table is None"""
+		database = database.lower()
+		if table is not None:
+			table = table.lower()
+		self.versions[(database, table)] = self.versions.get((database, table), 0) + 1
+		stale = []
+		for key in self.entries:
+			if key[0] == database and (table is None or key[1] == table):
+				stale.append(key)
+		for key in stale:
+			del self.entries[key]
+		self.invalidations += len(stale)
+		return len(stale)
+
+	def clear(self):
+		self.generation += 1
+		self.invalidations += len(self.entries)
+		self.entries.clear()
+
+	def stats(self):
+		"""Returns the cache counters as a dict"""
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"invalidations": self.invalidations,
+			"size": len(self.entries),
+			"max_size": self.max_size,
+		}
@@ -0,0 +1,625 @@
+import re
+import copy
+
+# Tokenizer and recursive descent parser for the SQL accepted by DBMS.sql.
+# - Keywords are case insensitive, identifiers are lowercased, literal values keep their case.
+# - Where a name is expected a keyword is read as a name, so columns and tables may be named like keywords.
+# - Values may be 'single' or "double" quoted strings (doubling the quote escapes it), bare words, numbers or NULL.
+# - Parameters are bound with ? (positional) or :name (named) placeholders and filled in by PreparedStatement.execute.
+# - Several statements separated by ; are parsed into a Script.
+# - SELECT accepts the aggregates COUNT(*), COUNT, SUM, AVG, MIN and MAX of a column with an optional GROUP BY.
+# - CREATE TABLE accepts SHARDS n BY column after the columns to spread the table's rows over n channels.
+# - EXPLAIN [ANALYZE] before a SELECT, INSERT, UPDATE or DELETE returns its plan, ANALYZE also runs it.
+# Statements are parsed into the statement classes below and executed by DBMS.run_statement.
+# Each statement reports the tables it reads and writes so a Script can run statements on disjoint tables concurrently.
+# The master table of the active database is tracked as "master", which is a reserved table name, and materialized
+# views as "view:" followed by their name, which no table name can be.
+
+KEYWORDS = {
+	"use", "create", "drop", "alter", "database", "table", "add", "column", "modify", "rename", "to",
+	"select", "from", "against", "where", "insert", "into", "values", "update", "set", "delete", "null",
+	"group", "by", "materialized", "view", "as", "explain", "analyze", "shards",
+}
+
+AGGREGATES = ("count", "sum", "avg", "min", "max")
+
+TOKEN_PATTERN = re.compile(r"""
+	(?P<space>\s+)
+	|(?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")
+	|(?P<number>-?\d[\w.:\-]*)
+	|(?P<word>[A-Za-z_][A-Za-z0-9_]*)
+	|(?P<param>\?|:[A-Za-z_][A-Za-z0-9_]*)
+	|(?P<operator>>=|=>|<=|=<|!=|=!|<>|==|=|<|>)
+	|(?P<punctuation>[(),;*])
+""", re.VERBOSE)
+
+OPERATORS = {
+	"=": "=", "==": "=",
+	"!=": "!=", "=!": "!=", "<>": "!=",
+	"<": "<", ">": ">",
+	"<=": "<=", "=<": "<=",
+	">=": ">=", "=>": ">=",
+}
+
+class Token:
+	def __init__(self, kind, value, position):
+		self.kind = kind # keyword, identifier, string, number, param, operator, punctuation or end
+		self.value = value
+		self.position = position
+
+	def __repr__(self):
+		return "Token(" + self.kind + ", " + repr(self.value) + ")"
+
+def tokenize(sql):
+	"""Returns the list of Token in sql, ending with an end token"""
+	if not isinstance(sql, str):
+		raise TypeError("sql must be a str")
+	tokens = []
+	position = 0
+	while position < len(sql):
+		match = TOKEN_PATTERN.match(sql, position)
+		if match is None:
+			raise NameError("Malformed sql; unexpected character " + repr(sql[position]) + " at " + str(position))
+		kind = match.lastgroup
+		text = match.group()
+		if kind == "string":
+			tokens.append(Token("string", text[1:-1].replace(text[0] * 2, text[0]), position))
+		elif kind == "word":
+			if text.lower() in KEYWORDS:
+				tokens.append(Token("keyword", text.lower(), position))
+			else:
+				tokens.append(Token("identifier", text, position))
+		elif kind == "operator":
+			tokens.append(Token("operator", OPERATORS[text], position))
+		elif kind != "space":
+			tokens.append(Token(kind, text, position))
+		position = match.end()
+	tokens.append(Token("end", None, position))
+	return tokens
+
+# STATEMENTS #
+
+class Param:
+	"""Placeholder for a value bound at execution, key is an int for ? and a str for :name"""
+	def __init__(self, key):
+		self.key = key
+
+	def __repr__(self):
+		if isinstance(self.key, int):
+			return "?"
+		return ":" + self.key
+
+class Condition:
+	"""Parsed WHERE clause, operator is one of = != < > <= >="""
+	def __init__(self, field, operator, value):
+		self.field = field
+		self.operator = operator
+		self.value = value
+
+class Statement:
+	"""Base class for parsed statements"""
+	params = ()
+	barrier = False # statements that change which database is active or exists run alone
+	sql = None # source text of the statement
+
+	def bind(self, params):
+		"""Copy of the statement with each Param replaced by its value in params"""
+		check_params(self.params, params)
+		if len(self.params) == 0:
+			return self
+		return self.substitute(params)
+
+	def substitute(self, params):
+		bound = copy.copy(self)
+		for attr, value in vars(self).items():
+			setattr(bound, attr, bind_value(value, params))
+		bound.params = ()
+		return bound
+
+	def reads(self):
+		"""Set of tables the statement reads"""
+		return set()
+
+	def writes(self):
+		"""Set of tables the statement writes"""
+		return set()
+
+	def conflicts(self, other):
+		"""True if the statements touch a common table and at least one of them writes it"""
+		if self.barrier or other.barrier:
+			return True
+		if self.writes() & (other.reads() | other.writes()):
+			return True
+		return len(self.reads() & other.writes()) > 0
+
+def check_params(keys, params):
+	if len(keys) == 0:
+		if params:
+			raise TypeError("Statement takes no parameters")
+		return
+	if params is None:
+		raise TypeError("Statement requires " + str(len(keys)) + " parameter(s)")
+	if isinstance(keys[0], int):
+		if isinstance(params, (str, dict)) or len(params) != len(keys):
+			raise TypeError("Statement requires " + str(len(keys)) + " positional parameter(s)")
+	else:
+		if not isinstance(params, dict):
+			raise TypeError("Statement requires named parameters as a dict")
+		for key in keys:
+			if key not in params:
+				raise NameError("No value for parameter :" + key)
+
+def bind_value(value, params):
+	if isinstance(value, Param):
+		return params[value.key]
+	if isinstance(value, list):
+		return [bind_value(v, params) for v in value]
+	if isinstance(value, tuple):
+		return tuple(bind_value(v, params) for v in value)
+	if isinstance(value, Condition):
+		return Condition(value.field, value.operator, bind_value(value.value, params))
+	return value
+
+class UseStatement(Statement):
+	barrier = True
+
+	def __init__(self, name):
+		self.name = name
+
+class CreateDatabaseStatement(Statement):
+	barrier = True
+
+	def __init__(self, name):
+		self.name = name
+
+class DropDatabaseStatement(Statement):
+	barrier = True
+
+	def __init__(self, name):
+		self.name = name
+
+class AlterDatabaseStatement(Statement):
+	barrier = True
+
+	def __init__(self, name):
+		self.name = name
+
+class CreateTableStatement(Statement):
+	def __init__(self, name, columns, shards=1, shard_key=""):
+		self.name = name
+		self.columns = columns # list of (column, datatype)
+		self.shards = shards
+		self.shard_key = shard_key
+
+	def writes(self):
+		return {"master", self.name}
+
+class DropTableStatement(Statement):
+	def __init__(self, name):
+		self.name = name
+
+	def writes(self):
+		return {"master", self.name}
+
+class AlterTableStatement(Statement):
+	def __init__(self, name, operations):
+		self.name = name
+		self.operations = operations # list of (action, argument), action is add, drop, modify or rename
+
+	def writes(self):
+		tables = {"master", self.name}
+		for action, argument in self.operations:
+			if action == "rename":
+				tables.add(argument)
+		return tables
+
+class SelectStatement(Statement):
+	def __init__(self, columns, table, where=None, aggregates=None, group_by=None):
+		self.columns = columns # list of column names, empty for *
+		self.table = table
+		self.where = where
+		self.aggregates = aggregates if aggregates is not None else [] # list of (function, column or *)
+		self.group_by = group_by
+
+	def reads(self):
+		return {"master", self.table}
+
+class CreateMaterializedViewStatement(Statement):
+	def __init__(self, name, select):
+		self.name = name
+		self.select = select
+
+	def substitute(self, params):
+		bound = Statement.substitute(self, params)
+		bound.select = self.select.substitute(params)
+		return bound
+
+	def reads(self):
+		return self.select.reads()
+
+	def writes(self):
+		return {"view:" + self.name}
+
+class DropMaterializedViewStatement(Statement):
+	def __init__(self, name):
+		self.name = name
+
+	def writes(self):
+		return {"view:" + self.name}
+
+class InsertStatement(Statement):
+	def __init__(self, table, columns, values):
+		self.table = table
+		self.columns = columns
+		self.values = values
+
+	def reads(self):
+		return {"master"}
+
+	def writes(self):
+		return {self.table}
+
+class UpdateStatement(Statement):
+	def __init__(self, table, assignments, where=None):
+		self.table = table
+		self.assignments = assignments # list of (column, value)
+		self.where = where
+
+	def reads(self):
+		return {"master"}
+
+	def writes(self):
+		return {self.table}
+
+class DeleteStatement(Statement):
+	def __init__(self, table, where=None):
+		self.table = table
+		self.where = where
+
+	def reads(self):
+		return {"master"}
+
+	def writes(self):
+		return {self.table}
+
+class ExplainStatement(Statement):
+	def __init__(self, statement, analyze=False):
+		self.statement = statement
+		self.analyze = analyze # run the statement and report what it actually cost
+
+	def substitute(self, params):
+		bound = ExplainStatement(self.statement.substitute(params), self.analyze)
+		bound.sql = self.sql
+		return bound
+
+	def reads(self):
+		if self.analyze:
+			return self.statement.reads()
+		return self.statement.reads() | self.statement.writes()
+
+	def writes(self):
+		if self.analyze:
+			return self.statement.writes()
+		return set()
+
+class Script(Statement):
+	"""Several statements run as one, statements on disjoint tables may run concurrently"""
+	def __init__(self, statements):
+		self.statements = statements
+
+	def substitute(self, params):
+		statements = []
+		for statement in self.statements:
+			if len(statement.params) > 0:
+				statement = statement.substitute(params)
+			statements.append(statement)
+		script = Script(statements)
+		script.sql = self.sql
+		return script
+
+	def reads(self):
+		return set().union(*[s.reads() for s in self.statements])
+
+	def writes(self):
+		return set().union(*[s.writes() for s in self.statements])
+
+	@property
+	def barrier(self):
+		return any(s.barrier for s in self.statements)
+
+	def dependencies(self):
+		"""For each statement the indexes of earlier statements it has to wait for"""
+		dependencies = []
+		for i in range(len(self.statements)):
+			dependencies.append([j for j in range(i) if self.statements[i].conflicts(self.statements[j])])
+		return dependencies
+
+# PARSER #
+
+class Parser:
+	def __init__(self, sql):
+		self.sql = sql
+		self.tokens = tokenize(sql)
+		self.index = 0
+		self.params = [] # every parameter in the sql
+		self.statement_params = [] # parameters in the statement being parsed
+
+	def parse(self):
+		"""Parses a single statement, a trailing ; is allowed"""
+		statement = self.parse_statement()
+		self.accept("punctuation", ";")
+		self.expect("end")
+		return statement
+
+	def parse_script(self):
+		"""Parses ; separated statements, returns a Statement if there is only one and a Script otherwise"""
+		statements = []
+		while True:
+			while self.accept("punctuation", ";") is not None:
+				pass
+			if self.peek().kind == "end":
+				break
+			statements.append(self.parse_statement())
+			if self.accept("punctuation", ";") is None:
+				self.expect("end")
+				break
+		if len(statements) == 0:
+			self.error("expected a statement")
+		if len(statements) == 1:
+			return statements[0]
+		script = Script(statements)
+		script.params = tuple(self.params)
+		script.sql = self.sql.strip()
+		return script
+
+	# helpers
+
+	def peek(self):
+		return self.tokens[self.index]
+
+	def advance(self):
+		token = self.tokens[self.index]
+		if token.kind != "end":
+			self.index += 1
+		return token
+
+	def accept(self, kind, value=None):
+		"""Consumes and returns the next token if it matches, otherwise returns None"""
+		token = self.peek()
+		if token.kind == kind and (value is None or token.value == value):
+			return self.advance()
+		return None
+
+	def expect(self, kind, value=None):
+		token = self.accept(kind, value)
+		if token is None:
+			self.error("expected " + (value if value is not None else kind))
+		return token
+
+	def error(self, message):
+		token = self.peek()
+		near = "end of statement" if token.kind == "end" else repr(self.sql[token.position:token.position + 16])
+		raise NameError("Malformed sql; " + message + " near " + near)
+
+	def identifier(self):
+		token = self.peek()
+		if token.kind not in ("identifier", "keyword"): # keywords are names wherever a name is expected
+			self.error("expected a name")
+		return self.advance().value.lower()
+
+	def value(self):
+		token = self.peek()
+		if token.kind in ("string", "number", "identifier"): # identifiers are bare word values
+			return self.advance().value
+		if token.kind == "keyword" and token.value == "null":
+			self.advance()
+			return None
+		if token.kind == "param":
+			return self.param(self.advance())
+		self.error("expected a value")
+
+	def param(self, token):
+		if token.value == "?":
+			key = len(self.params)
+		else:
+			key = token.value[1:]
+		if len(self.params) > 0 and isinstance(self.params[0], int) != isinstance(key, int):
+			self.error("cannot mix ? and :name parameters")
+		if key not in self.params:
+			self.params.append(key)
+		if key not in self.statement_params:
+			self.statement_params.append(key)
+		return Param(key)
+
+	def where(self):
+		if self.accept("keyword", "where") is None:
+			return None
+		field = self.identifier()
+		operator = self.expect("operator").value
+		return Condition(field, operator, self.value())
+
+	def against(self):
+		if self.accept("keyword", "from") is None:
+			self.expect("keyword", "against")
+		return self.identifier()
+
+	# statements
+
+	def parse_statement(self):
+		token = self.peek()
+		handler = None
+		if token.kind == "keyword":
+			handler = getattr(self, "parse_" + token.value, None)
+		if handler is None:
+			self.error("unknown statement")
+		self.advance()
+		self.statement_params = []
+		statement = handler()
+		if len(self.statement_params) > 0:
+			statement.params = tuple(self.statement_params)
+		statement.sql = self.sql[token.position:self.peek().position].strip()
+		return statement
+
+	def parse_use(self):
+		return UseStatement(self.identifier())
+
+	def parse_create(self):
+		if self.accept("keyword", "database"):
+			return CreateDatabaseStatement(self.identifier())
+		if self.accept("keyword", "materialized"):
+			self.expect("keyword", "view")
+			name = self.identifier()
+			self.expect("keyword", "as")
+			self.expect("keyword", "select")
+			return CreateMaterializedViewStatement(name, self.parse_select())
+		self.expect("keyword", "table")
+		name = self.identifier()
+		columns = []
+		self.expect("punctuation", "(")
+		while True:
+			columns.append((self.identifier(), self.identifier()))
+			if self.accept("punctuation", ",") is None:
+				break
+		self.expect("punctuation", ")")
+		if self.accept("keyword", "shards") is None:
+			return CreateTableStatement(name, columns)
+		count = self.expect("number").value
+		if not count.isdigit():
+			self.index -= 1
+			self.error("expected a number of shards")
+		self.expect("keyword", "by")
+		return CreateTableStatement(name, columns, int(count), self.identifier())
+
+	def parse_drop(self):
+		if self.accept("keyword", "database"):
+			return DropDatabaseStatement(self.identifier())
+		if self.accept("keyword", "materialized"):
+			self.expect("keyword", "view")
+			return DropMaterializedViewStatement(self.identifier())
+		self.expect("keyword", "table")
+		return DropTableStatement(self.identifier())
+
+	def parse_alter(self):
+		if self.accept("keyword", "database"):
+			return AlterDatabaseStatement(self.identifier())
+		self.expect("keyword", "table")
+		name = self.identifier()
+		operations = []
+		while True:
+			action = self.expect("keyword").value
+			if action in ("add", "drop", "modify"):
+				self.accept("keyword", "column")
+			if action == "add":
+				operations.append((action, self.identifier() + " " + self.identifier()))
+			elif action == "drop":
+				operations.append((action, self.identifier()))
+			elif action == "modify":
+				column = self.identifier()
+				rename = self.identifier()
+				if self.peek().kind == "identifier":
+					operations.append((action, column + " " + rename + " " + self.identifier()))
+				else: # MODIFY column datatype keeps the name
+					operations.append((action, column + " " + column + " " + rename))
+			elif action == "rename":
+				self.accept("keyword", "to")
+				operations.append((action, self.identifier()))
+			else:
+				self.index -= 1
+				self.error("expected ADD, DROP, MODIFY or RENAME")
+			if self.accept("punctuation", ",") is None:
+				break
+		return AlterTableStatement(name, operations)
+
+	def parse_select(self):
+		columns = []
+		aggregates = []
+		if self.accept("punctuation", "*") is None:
+			while True:
+				name = self.identifier()
+				if name in AGGREGATES and self.accept("punctuation", "(") is not None:
+					if self.accept("punctuation", "*") is not None:
+						if name != "count":
+							self.error("only COUNT accepts *")
+						aggregates.append((name, "*"))
+					else:
+						aggregates.append((name, self.identifier()))
+					self.expect("punctuation", ")")
+				else:
+					columns.append(name)
+				if self.accept("punctuation", ",") is None:
+					break
+		table = self.against()
+		where = self.where()
+		group_by = None
+		if self.accept("keyword", "group") is not None:
+			self.expect("keyword", "by")
+			group_by = self.identifier()
+		if group_by is not None and len(aggregates) == 0:
+			self.error("GROUP BY requires an aggregate")
+		if len(aggregates) > 0 and any(c != group_by for c in columns):
+			self.error("only the GROUP BY column can be selected with aggregates")
+		return SelectStatement(columns, table, where, aggregates, group_by)
+
+	def parse_insert(self):
+		self.expect("keyword", "into")
+		table = self.identifier()
+		columns = []
+		self.expect("punctuation", "(")
+		while True:
+			columns.append(self.identifier())
+			if self.accept("punctuation", ",") is None:
+				break
+		self.expect("punctuation", ")")
+		self.expect("keyword", "values")
+		values = []
+		self.expect("punctuation", "(")
+		while True:
+			values.append(self.value())
+			if self.accept("punctuation", ",") is None:
+				break
+		self.expect("punctuation", ")")
+		if len(columns) != len(values):
+			self.error("number of columns and values do not match")
+		return InsertStatement(table, columns, values)
+
+	def parse_update(self):
+		table = self.identifier()
+		self.expect("keyword", "set")
+		assignments = []
+		while True:
+			column = self.identifier()
+			if self.expect("operator").value != "=":
+				self.index -= 1
+				self.error("expected =")
+			assignments.append((column, self.value()))
+			if self.accept("punctuation", ",") is None:
+				break
+		return UpdateStatement(table, assignments, self.where())
+
+	def parse_delete(self):
+		return DeleteStatement(self.against(), self.where())
+
+	def parse_explain(self):
+		analyze = self.accept("keyword", "analyze") is not None
+		token = self.peek()
+		if token.kind != "keyword" or token.value not in ("select", "insert", "update", "delete"):
+			self.error("expected SELECT, INSERT, UPDATE or DELETE")
+		return ExplainStatement(self.parse_statement(), analyze)
+
+def parse(sql):
+	"""Parses sql into a Statement, or a Script if sql holds several ; separated statements"""
+	return Parser(sql).parse_script()
+
+class PreparedStatement:
+	"""A parsed statement bound to a DBMS, executed with a new set of parameters each time"""
+	def __init__(self, dbms, sql, statement):
+		self.dbms = dbms
+		self.sql = sql
+		self.statement = statement
+
+	@property
+	def params(self):
+		return self.statement.params
+
+	async def execute(self, params=None):
+		return await self.dbms.run_statement(self.statement.bind(params))
@@ -0,0 +1,58 @@
+import zlib
+
+# Sharded tables spread their rows over several text channels, optionally in several guilds.
+# - Shard 0 is the table's own channel, shard i is the channel "<table>-<i>" in the category of the same database
+#   on guild i modulo the number of guilds.  Table names are alphanumeric so shard channels never collide with tables.
+# - The layout is kept in the master table as the record "<table> shards│count│shard key│guild ids│" next to the
+#   table's header record, the space keeps it from matching a table name.
+# - A row is written to the shard its shard key value hashes to, scans read every shard concurrently and merge
+#   the rows newest first.  A where clause testing the shard key for equality only reads its one shard.
+
+SHARD_SUFFIX = " shards"
+
+class ShardMap:
+	"""Layout of a sharded table"""
+	def __init__(self, table_name, count, key, guild_ids):
+		self.table_name = table_name
+		self.count = count
+		self.key = key # column the rows are distributed by
+		self.guild_ids = guild_ids # guilds the shards are spread over, shard i is on guild_ids[i % len(guild_ids)]
+
+	@staticmethod
+	def parse(content):
+		"""ShardMap from a master table record, None if the record is not a shard record"""
+		fields = content.split(chr(0x2502))
+		if len(fields) < 4 or not fields[0].endswith(SHARD_SUFFIX):
+			return None
+		return ShardMap(fields[0][:-len(SHARD_SUFFIX)], int(fields[1]), fields[2], [int(id) for id in fields[3].split(" ")])
+
+	def record(self):
+		"""Content of the master table record"""
+		return self.table_name + SHARD_SUFFIX + chr(0x2502) + str(self.count) + chr(0x2502) + self.key + chr(0x2502) + " ".join(str(id) for id in self.guild_ids) + chr(0x2502)
+
+	def channel_name(self, index):
+		if index == 0:
+			return self.table_name
+		return self.table_name + "-" + str(index)
+
+	def guild_id(self, index):
+		return self.guild_ids[index % len(self.guild_ids)]
+
+	def shard(self, value, datatype="str"):
+		"""Index of the shard rows with value in the shard key column belong to"""
+		value = str(value).strip()
+		try: # equal numbers hash the same however they are written
+			if datatype == "int":
+				value = str(int(value))
+			elif datatype == "float":
+				value = repr(float(value))
+		except ValueError:
+			pass
+		return zlib.crc32(value.encode("utf-8")) % self.count
+
+def shard_table_name(channel_name):
+	"""Name of the table a channel belongs to, the channel name itself for unsharded tables and shard 0"""
+	name, separator, index = channel_name.rpartition("-")
+	if separator and index.isdigit() and name.isalnum():
+		return name
+	return channel_name
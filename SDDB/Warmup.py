@@ -0,0 +1,42 @@
+from collections import OrderedDict
+from .Instrumentation import milliseconds
+
+# Warm up fills the caches of a DBMS before its first statement, see DBMS.warm.
+# - The master tables of the databases are read once each and kept in the schema cache, so statements resolve tables
+#   without reading them again.
+# - The hot tables are scanned, refreshing their stats for the planner, their full contents are kept in the query
+#   cache and stale materialized views over them are reloaded.
+# - Databases and tables are loaded concurrently, at most concurrency at once.  A database or table that fails to load
+#   is reported and does not stop the others.
+# - The report lists what the caches hold once warm up ends.  Without a schema_cache databases are skipped, without a
+#   query_cache tables are, reads evicted or invalidated before warm up ended are reported as skipped too.
+
+class WarmReport:
+	"""What warming up a DBMS loaded and how long it took"""
+	def __init__(self):
+		self.schemas = OrderedDict() # database name -> master table records kept in the schema cache
+		self.tables = OrderedDict() # database.table -> rows kept in the query cache
+		self.views_reloaded = 0
+		self.skipped = OrderedDict() # database or database.table -> why it is not kept
+		self.errors = OrderedDict() # database or database.table -> error
+		self.duration = 0.0
+
+	@property
+	def rows(self):
+		return sum(self.tables.values())
+
+	def __str__(self):
+		lines = ["warm (time=" + milliseconds(self.duration) + ")"]
+		lines.append("  schemas=" + str(len(self.schemas)) + describe(self.schemas))
+		lines.append("  tables=" + str(len(self.tables)) + " rows=" + str(self.rows) + describe(self.tables))
+		lines.append("  views reloaded=" + str(self.views_reloaded))
+		for name, reason in self.skipped.items():
+			lines.append("  skipped " + name + ": " + reason)
+		for name, error in self.errors.items():
+			lines.append("  error " + name + ": " + error)
+		return "\n".join(lines)
+
+def describe(loaded):
+	if len(loaded) == 0:
+		return ""
+	return " (" + ", ".join(name + "=" + str(count) for name, count in loaded.items()) + ")"
@@ -1 +1,4 @@
-from .DatabaseDiscord import *
\ No newline at end of file
+from .DatabaseDiscord import *
+from .QueryCache import QueryCache
+from .Backend import Backend, DiscordBackend, MemoryBackend
+from .Planner import ACCESS, Plan, TableStats
@@ -0,0 +1,105 @@
+import asyncio
+from contextlib import contextmanager
+from SDDB.Backend import MemoryBackend, RATE_LIMITS, GLOBAL_RATE_LIMIT
+from SDDB.Instrumentation import RouteStats
+
+# A local Discord stand-in for benchmarks, a MemoryBackend that accounts for every request it would make to Discord.
+# - MemoryBackend maps each operation to the Discord REST route discord.py uses, history is paged 100 messages per request.
+# - Routes share rate limit buckets per major parameter (channel or guild) with fixed windows like Discord,
+#   plus a global bucket, a request waits for the bucket to reset once it runs out.
+# - Every request costs a fixed latency.
+# By default time is simulated, waits and latency advance a clock instead of sleeping so benchmarks run at full speed.
+# Concurrent requests are serialized on the simulated clock, use realtime=True to sleep for real and overlap them.
+# Further clients of the same guild (shared=) have their own buckets like separate bot tokens but share the clock.
+# Rate limits default to Backend.RATE_LIMITS and GLOBAL_RATE_LIMIT.
+
+class Clock:
+	def __init__(self):
+		self.now = 0.0 # simulated seconds spent on requests
+
+class Bucket:
+	"""A fixed window rate limit bucket"""
+	def __init__(self, limit, per):
+		self.limit = limit
+		self.per = per
+		self.remaining = limit
+		self.reset_at = None
+
+	def acquire(self, now):
+		"""Takes one request at time now, returns how long it has to wait first"""
+		if self.reset_at is None or now >= self.reset_at:
+			self.remaining = self.limit
+			self.reset_at = now + self.per
+		wait = 0.0
+		if self.remaining == 0:
+			wait = self.reset_at - now
+			self.remaining = self.limit
+			self.reset_at = self.reset_at + self.per
+		self.remaining -= 1
+		return wait
+
+class RateLimitedBackend(MemoryBackend):
+	def __init__(self, latency=0.05, rate_limits=None, global_rate_limit=GLOBAL_RATE_LIMIT, realtime=False, shared=None):
+		MemoryBackend.__init__(self, shared=shared)
+		self.latency = latency
+		self.rate_limits = dict(RATE_LIMITS)
+		if rate_limits is not None:
+			self.rate_limits.update(rate_limits)
+		self.global_bucket = Bucket(*global_rate_limit) if global_rate_limit is not None else None
+		self.realtime = realtime
+		self.timeline = shared.timeline if shared is not None else Clock()
+		self.buckets = {} # (route, major) -> Bucket
+		self.routes = {} # route -> RouteStats
+		self.metered = True
+
+	@property
+	def clock(self):
+		"""Simulated seconds spent on requests by every client of the guild"""
+		return self.timeline.now
+
+	@clock.setter
+	def clock(self, value):
+		self.timeline.now = value
+
+	@contextmanager
+	def unmetered(self):
+		"""Operations inside are free, for seeding tables"""
+		self.metered = False
+		try:
+			yield
+		finally:
+			self.metered = True
+
+	def reset(self):
+		"""Clears the request counters, rate limit buckets keep their state"""
+		self.routes = {}
+		self.clock = 0.0
+
+	@property
+	def requests(self):
+		return sum(stats.requests for stats in self.routes.values())
+
+	@property
+	def wait(self):
+		return sum(stats.wait for stats in self.routes.values())
+
+	async def request(self, route, major, size=0):
+		self.check_connected()
+		if not self.metered:
+			return
+		wait = 0.0
+		if self.global_bucket is not None:
+			wait += self.global_bucket.acquire(self.clock)
+		if route in self.rate_limits:
+			key = (route, major)
+			if key not in self.buckets:
+				self.buckets[key] = Bucket(*self.rate_limits[route])
+			wait += self.buckets[key].acquire(self.clock + wait)
+		stats = self.routes.setdefault(route, RouteStats())
+		stats.requests += 1
+		stats.bytes += size
+		stats.wait += wait
+		self.clock += wait + self.latency
+		self.report_request(route, size, wait)
+		if self.realtime:
+			await asyncio.sleep(wait + self.latency)
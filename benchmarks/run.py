@@ -0,0 +1,134 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+from contextlib import ExitStack
+import SDDB
+from .RateLimitedBackend import RateLimitedBackend
+
+# Benchmarks SDDB operations at several table sizes against RateLimitedBackend.
+# Each operation runs on a freshly seeded table and reports API calls, simulated Discord time
+# (latency and rate limit waits), rate limit waits alone, bytes transferred, rows scanned, decode time, wall time
+# and peak memory.
+# Tables past 1024 rows are seeded directly, SDDB only ever reads the newest 1024 rows of a table.
+#
+#   python -m benchmarks.run
+#   python -m benchmarks.run --sizes 16,1024 --operations query,update --json results.json
+#   python -m benchmarks.run --clients 4
+
+SIZES = [16, 128, 512, 1024, 1536]
+TEAMS = 10 # rows are spread over this many teams, most where clauses match one team
+
+async def seed(backends, dbms, size):
+	"""Creates the bench database with a table of size rows and a small second table, without metering"""
+	backend = backends[0]
+	with ExitStack() as stack:
+		for client in backends:
+			stack.enter_context(client.unmetered())
+		await dbms.create_database("bench")
+		await dbms.create_table("people", who="str", team="str", age="int")
+		await dbms.create_table("other", x="int")
+		people, other = None, None
+		for channel in backend.channels(dbms.ad):
+			if channel.name == "people":
+				people = channel
+			if channel.name == "other":
+				other = channel
+		for i in range(size):
+			await backend.send(people, "person" + str(i) + chr(0x2502) + "team" + str(i % TEAMS) + chr(0x2502) + str(i) + chr(0x2502))
+		for i in range(8):
+			await backend.send(other, str(i) + chr(0x2502))
+
+OPERATIONS = [
+	("create_table", lambda dbms, size: dbms.create_table("fresh", a="str", b="int")),
+	("insert_into", lambda dbms, size: dbms.insert_into("people", who="new", team="team0", age="1")),
+	("query", lambda dbms, size: dbms.query(against="people", where="team = team3")),
+	("update", lambda dbms, size: dbms.update("people", where="team = team3", age="0")),
+	("delete", lambda dbms, size: dbms.delete("people", where="team = team3")),
+	("alter_table", lambda dbms, size: dbms.alter_table("people", add="extra str")),
+	("sql", lambda dbms, size: dbms.sql("SELECT who FROM people WHERE team = 'team1'; SELECT * FROM other; INSERT INTO other (x) VALUES (9)")),
+]
+
+async def measure(name, operation, size, latency, realtime, cache, clients=1):
+	backends = [RateLimitedBackend(latency=latency, realtime=realtime)]
+	for i in range(1, clients): # further bot tokens on the same guild
+		backends.append(RateLimitedBackend(latency=latency, realtime=realtime, shared=backends[0]))
+	statements = []
+	backend = backends[0]
+	if clients > 1:
+		backend = SDDB.BackendPool(backends, clock=lambda: backends[0].clock)
+	dbms = SDDB.DBMS(backend, query_cache=SDDB.QueryCache() if cache else None, instrument=statements.append)
+	await seed(backends, dbms, size)
+	for backend in backends:
+		backend.reset()
+	del statements[:]
+	error = None
+	tracemalloc.start()
+	start = time.perf_counter()
+	try:
+		await operation(dbms, size)
+	except Exception as e:
+		error = str(e)
+	wall = time.perf_counter() - start
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	routes = {}
+	for backend in backends:
+		for route, stats in backend.routes.items():
+			routes[route] = routes.get(route, 0) + stats.requests
+	return {
+		"operation": name,
+		"rows": size,
+		"clients": clients,
+		"api_calls": sum(backend.requests for backend in backends),
+		"simulated_s": round(backends[0].clock, 3),
+		"rate_limit_wait_s": round(sum(backend.wait for backend in backends), 3),
+		"bytes": sum(stats.bytes for backend in backends for stats in backend.routes.values()),
+		"rows_scanned": sum(stats.rows_scanned for stats in statements),
+		"decode_ms": round(sum(stats.decode_time for stats in statements) * 1000, 3),
+		"wall_ms": round(wall * 1000, 3),
+		"peak_kib": round(peak / 1024, 1),
+		"routes": routes,
+		"error": error,
+	}
+
+def report(results, out=sys.stdout):
+	columns = ["operation", "rows", "clients", "api_calls", "simulated_s", "rate_limit_wait_s", "bytes", "rows_scanned", "decode_ms", "wall_ms", "peak_kib"]
+	widths = [max(len(c), max(len(str(r[c])) for r in results)) for c in columns]
+	out.write("  ".join(c.ljust(w) for c, w in zip(columns, widths)) + "\n")
+	for r in results:
+		line = "  ".join(str(r[c]).ljust(w) for c, w in zip(columns, widths))
+		if r["error"] is not None:
+			line += "  error: " + r["error"]
+		out.write(line + "\n")
+
+async def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark SDDB operations against a rate limited Discord stand-in")
+	parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES), help="comma separated table sizes")
+	parser.add_argument("--operations", default=",".join(name for name, op in OPERATIONS), help="comma separated operations")
+	parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+	parser.add_argument("--realtime", action="store_true", help="sleep for latency and rate limits instead of simulating them")
+	parser.add_argument("--cache", action="store_true", help="enable the query result cache")
+	parser.add_argument("--clients", type=int, default=1, help="bot tokens in the client pool")
+	parser.add_argument("--json", help="also write the results to this file")
+	args = parser.parse_args(argv)
+
+	selected = args.operations.split(",")
+	unknown = set(selected) - set(name for name, op in OPERATIONS)
+	if unknown:
+		parser.error("unknown operations: " + ", ".join(sorted(unknown)))
+	results = []
+	for size in [int(s) for s in args.sizes.split(",")]:
+		for name, operation in OPERATIONS:
+			if name in selected:
+				results.append(await measure(name, operation, size, args.latency, args.realtime, args.cache, args.clients))
+	report(results)
+	if args.json:
+		with open(args.json, "w", encoding="utf-8") as fh:
+			json.dump(results, fh, indent=2)
+	return results
+
+if __name__ == "__main__":
+	asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,267 @@
+import os
+import copy
+import types
+import shutil
+import asyncio
+import logging
+import tempfile
+import unittest
+import SDDB
+from SDDB.Backend import MemoryBackend, RateLimitLog
+from SDDB.Journal import Journal, PROVISIONAL
+from SDDB.SQLParser import parse
+
+# Smoke tests running SDDB end to end on MemoryBackend, no Discord client or network needed.
+# Run with python -m unittest discover tests, or pytest.
+
+def run(coroutine):
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(coroutine)
+	finally:
+		loop.close()
+
+def channel(backend, category, name):
+	return [c for c in backend.channels(category) if c.name == name][0]
+
+async def database(backend=None, **kwargs):
+	dbms = SDDB.DBMS(backend or MemoryBackend(), **kwargs)
+	await dbms.create_database("db")
+	return dbms
+
+class SlowHistory(MemoryBackend):
+	"""Holds the next read of table t until a write to it finished, with the rows as they were before the write"""
+	delay = False
+
+	async def history(self, channel, **kwargs):
+		messages = await MemoryBackend.history(self, channel, **kwargs)
+		if self.delay and channel.name == "t":
+			self.delay = False
+			messages = [copy.copy(message) for message in messages]
+			await asyncio.sleep(0.1)
+		return messages
+
+class ParserTest(unittest.TestCase):
+	def test_keywords_as_names(self):
+		statement = parse("SELECT group, by FROM t WHERE to = 1")
+		self.assertEqual(statement.table, "t")
+		statement = parse("CREATE TABLE t (group str, shards int) SHARDS 2 BY group")
+		self.assertEqual((statement.shards, statement.shard_key), (2, "group"))
+
+	def test_script_dependencies(self):
+		script = parse("INSERT INTO a (x) VALUES (1); INSERT INTO b (x) VALUES (1); SELECT * FROM a")
+		self.assertEqual(script.dependencies(), [[], [], [0]])
+		script = parse("CREATE MATERIALIZED VIEW v AS SELECT * FROM a; DROP MATERIALIZED VIEW v")
+		self.assertEqual(script.dependencies(), [[], [0]])
+
+	def test_script(self):
+		async def main():
+			dbms = await database()
+			await dbms.sql("CREATE TABLE p (who str, age int)")
+			await dbms.sql("INSERT INTO p (who, age) VALUES ('a', 40); CREATE MATERIALIZED VIEW v AS SELECT * FROM p; DROP MATERIALIZED VIEW v")
+			table = await dbms.sql("SELECT * FROM p WHERE age > 30")
+			return dbms, table
+		dbms, table = run(main())
+		self.assertEqual(len(table.rows), 1)
+		self.assertEqual(sorted(dbms.views), [])
+
+	def test_keyword_columns(self):
+		async def main():
+			dbms = await database()
+			await dbms.create_table("t", group="str", set="int")
+			await dbms.sql("INSERT INTO t (group, set) VALUES ('g', 1)")
+			await dbms.sql("UPDATE t SET set = 2 WHERE group = g")
+			return await dbms.sql("SELECT * FROM t WHERE group = g")
+		table = run(main())
+		self.assertEqual(table.rows[0].records[2].data, "2")
+
+class JournalTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "journal")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_flush(self):
+		async def main():
+			backend = MemoryBackend()
+			dbms = await database(backend, journal=Journal(self.path, sync=False))
+			await dbms.create_table("t", k="str", v="int")
+			for i in range(5):
+				await dbms.insert_into("t", k="a", v=str(i))
+			await dbms.update("t", where="v = 1", v="10")
+			pending = (await dbms.query(against="t", where="v = 10")).rows
+			await dbms.flush()
+			return backend, dbms, pending
+		backend, dbms, pending = run(main())
+		self.assertEqual(len(pending), 1)
+		self.assertEqual(len(dbms.journal), 0)
+		contents = sorted(m.content for m in channel(backend, dbms.ad, "t").messages.values())
+		self.assertEqual(len(contents), 5)
+		self.assertIn("a" + chr(0x2502) + "10" + chr(0x2502), contents)
+
+	def test_replay(self):
+		backend = MemoryBackend()
+		async def write():
+			dbms = await database(backend, journal=Journal(self.path, sync=False, delay=10.0))
+			await dbms.create_table("t", k="str", v="int")
+			for i in range(3):
+				await dbms.insert_into("t", k="a", v=str(i))
+			dbms.journal_task.cancel() # the process stops before the flush
+			dbms.journal.close()
+			return dbms.ad
+		async def replay():
+			dbms = SDDB.DBMS(backend, journal=Journal(self.path, sync=False))
+			recovered = dbms.journal.recovered
+			await dbms.flush()
+			return recovered
+		category = run(write())
+		self.assertEqual(len(channel(backend, category, "t").messages), 0)
+		self.assertEqual(run(replay()), 3)
+		self.assertEqual(len(channel(backend, category, "t").messages), 3)
+
+	def test_torn_tail(self):
+		journal = Journal(self.path, sync=False)
+		journal.append("send", 1, content="a")
+		journal.close()
+		with open(self.path, "a") as fh:
+			fh.write('{"seq": 2, "op": "se')
+		journal = Journal(self.path, sync=False)
+		self.assertEqual(journal.recovered, 1)
+		journal.append("send", 1, content="b")
+		journal.close()
+		journal = Journal(self.path, sync=False)
+		self.assertEqual([entry.content for entry in journal.entries.values()], ["a", "b"])
+		journal.close()
+
+	def test_provisional_ids(self):
+		journal = Journal(self.path, sync=False)
+		real = (123456789 << 22) | PROVISIONAL | 7 # a Discord id with every worker and process bit set
+		self.assertFalse(journal.provisional(real))
+		journal.append("edit", 1, real, "x")
+		send = journal.append("send", 1, content="a")
+		self.assertTrue(journal.provisional(send.message_id))
+		for write in journal.batch():
+			if write.op == "send":
+				journal.drop(write)
+			else:
+				journal.done(write)
+		self.assertRaises(NameError, journal.append, "edit", 1, send.message_id, "b")
+		journal.close()
+
+class ShardingTest(unittest.TestCase):
+	def test_shards(self):
+		async def main():
+			backend, other = MemoryBackend(), MemoryBackend()
+			dbms = await database(backend, shard_guilds=[other])
+			await dbms.sql("CREATE TABLE people (who str, team int) SHARDS 4 BY team")
+			for i in range(40):
+				await dbms.insert_into("people", who="p" + str(i), team=str(i % 7))
+			rows = (await dbms.query(against="people")).rows
+			team = (await dbms.query(against="people", where="team = 3")).rows
+			shards = [c for c in backend.channels(dbms.ad) if c.name != "db"] + other.categories()[0].channels
+			spread = [len(c.messages) for c in shards]
+			return rows, team, spread
+		rows, team, spread = run(main())
+		self.assertEqual(len(rows), 40)
+		self.assertEqual(len(team), 6)
+		self.assertEqual(len(spread), 4)
+		self.assertEqual(sum(spread), 40)
+		self.assertTrue(sum(1 for count in spread if count > 0) > 2)
+
+	def test_shards_column(self):
+		async def main():
+			dbms = await database()
+			await dbms.create_table("t", shards="int", key="str")
+			await dbms.create_table("u", _shards=2, _shard_key="key", key="str")
+			await dbms.insert_into("t", shards="3", key="x")
+			return await dbms.query(against="t")
+		self.assertEqual(run(main()).rows[0].records[1].data, "3")
+
+	def test_raw_event_on_shard_guild(self):
+		async def main():
+			backend, other = MemoryBackend(), MemoryBackend()
+			dbms = await database(backend, shard_guilds=[other])
+			await dbms.sql("CREATE TABLE p (k str, v int) SHARDS 2 BY k")
+			for k in "abcdef":
+				await dbms.insert_into("p", k=k, v="1")
+			shard = other.categories()[0].channels[0]
+			message = list(shard.messages.values())[0]
+			subscription = await dbms.subscribe("p")
+			dbms.on_raw_message_delete(types.SimpleNamespace(channel_id=shard.id, message_id=message.id, cached_message=message))
+			return len(subscription)
+		self.assertEqual(run(main()), 1)
+
+class FailureTest(unittest.TestCase):
+	def setUp(self):
+		logging.getLogger("SDDB").disabled = True
+
+	def tearDown(self):
+		logging.getLogger("SDDB").disabled = False
+
+	def test_subscription_does_not_fail_writes(self):
+		async def main():
+			dbms = await database()
+			await dbms.create_table("p", who="str", age="int")
+			subscription = await dbms.subscribe("p", where="age > 30")
+			await dbms.insert_into("p", who="x", age="abc")
+			await dbms.insert_into("p", who="y", age="40")
+			with self.assertRaises(NameError):
+				await dbms.subscribe("p", where="nope = 1")
+			with self.assertRaises(TypeError):
+				await dbms.subscribe("p", where="age = abc")
+			return len(subscription)
+		self.assertEqual(run(main()), 1)
+
+	def test_view_marked_stale(self):
+		async def main():
+			dbms = await database()
+			await dbms.create_table("p", who="str", age="int")
+			await dbms.insert_into("p", who="y", age="40")
+			await dbms.create_materialized_view("s", "SELECT SUM(age) FROM p")
+			await dbms.insert_into("p", who="x", age="abc")
+			return dbms.views["s"].stale
+		self.assertTrue(run(main()))
+
+	def test_cache_race(self):
+		async def main():
+			backend = SlowHistory()
+			dbms = await database(backend, query_cache=SDDB.QueryCache())
+			await dbms.create_table("t", who="str", age="int")
+			await dbms.insert_into("t", who="a", age="1")
+			backend.delay = True
+			read = asyncio.ensure_future(dbms.query(against="t"))
+			await asyncio.sleep(0.01)
+			await dbms.update("t", where="who = a", age="2")
+			await read # read before the update, must not be cached
+			return (await dbms.query(against="t")).rows[0].records[2].data
+		self.assertEqual(run(main()), "2")
+
+	def test_export_unconvertible(self):
+		async def main():
+			backend = MemoryBackend()
+			dbms = await database(backend)
+			await dbms.create_table("t", who="str", age="int")
+			await dbms.insert_into("t", who="a", age="30")
+			message = list(channel(backend, dbms.ad, "t").messages.values())[0]
+			message.content = message.content.replace("30", "abc") # edited outside SDDB
+			return (await dbms.query(against="t")).to_columns()
+		self.assertEqual(run(main())["age"], ["abc"])
+
+	def test_rate_limit_attribution(self):
+		log = RateLimitLog()
+		first, second = object(), object()
+		record = logging.LogRecord("discord.http", logging.WARNING, "", 0, "We are being rate limited. Retrying in %.2f seconds.", (2.5,), None)
+		async def request(backend, limited):
+			log.start(backend)
+			await asyncio.sleep(0)
+			if limited:
+				log.emit(record)
+			return log.pop(backend)
+		async def main():
+			return await asyncio.gather(request(first, True), request(second, False))
+		self.assertEqual(run(main()), [2.5, 0.0])
+
+if __name__ == "__main__":
+	unittest.main()